@@ -32,7 +32,8 @@
 # -------------- glink proper
 
 import argparse, json, string, functools, fnmatch
-import os, sys, traceback, copy, builtins
+import os, sys, traceback, copy, builtins, ast
+import hashlib, marshal, importlib.util
 import glccver
 
 args = None
@@ -40,10 +41,12 @@ rominfo = None
 romtype = None
 romcpu = None
 lccdir = '/usr/local/lib/gigatron-lcc'
+cachedir = None
 module_dict = {}
 module_builtins = {}
 module_list = []
 segment_list = []
+segment_index = None
 new_modules = []
 
 symdefs = {}
@@ -54,6 +57,7 @@ the_segment = None
 the_fragment = None
 the_pc = 0
 the_pass = 0
+the_trace = None
 
 final_pass = False
 hops_enabled = False
@@ -204,7 +208,7 @@ def resolve(s, ignore=None):
 class Fragment:
     "Class for representing the code/data fragments in a module"
     __slots__ = ('cseg', 'name','func', 'size', 'align',
-                 'nohop', 'amin', 'amax', 'aoff', 'passed')
+                 'nohop', 'amin', 'amax', 'aoff', 'passed', 'trace')
     def __init__(self, cseg, name, func, size = None, align = None):
         self.cseg = cseg           # CODE, DATA, BSS, COMMON
         self.name = name           # fragment name
@@ -216,12 +220,26 @@ class Fragment:
         self.amin = None           # min address range
         self.amax = None           # max address range
         self.passed = -1           # successfully assembled in that pass
+        self.trace = None          # inputs and effects of the last assembly
     def __repr__(self):
         return f"Fragment({self.cseg},'{self.name}',...)"
 
+class Chunk:
+    "Class for representing the part of a library that defines some modules"
+    __slots__ = ('fname', 'line', 'source', 'modules')
+    def __init__(self, fname, line, source):
+        self.fname = fname         # library file name
+        self.line = line           # first line in the library file
+        self.source = source       # python source (bytes)
+        self.modules = []          # modules from the table of contents
+    def __repr__(self):
+        return f"Chunk('{self.fname}',{self.line})"
+
 class Module:
-    '''Class for assembly modules read from .s/.o/.a files.'''
-    def __init__(self, name=None, cpu=None, code=None):
+    '''Class for assembly modules read from .s/.o/.a files.
+       Modules listed in a library table of contents have a chunk
+       and no code until the closure selects them.'''
+    def __init__(self, name=None, cpu=None, code=None, chunk=None):
         global args, current_module
         self.cpu = cpu if cpu != None else args.cpu
         self.code = []
@@ -229,6 +247,7 @@ class Module:
         self.fname = name
         self.library = False
         self.used = False
+        self.chunk = chunk
         self.exports = []
         self.imports = []
         self.cimports = []
@@ -288,6 +307,9 @@ class Module:
                     error(f"Cannot locate fragment for {tp}") # ('NOHOP', "pattern")
             elif tp[0] != 'NOP':                              # ('NOP',)
                 error(f"Unrecognized fragment specification {tp}")
+        # placement happens when a chunk is loaded
+        if chunk:
+            return
         # placement overlay
         if map_place:
             fragnames = [f.name for f in self.code]
@@ -414,16 +436,16 @@ def hop(sz, jump):
         else:
             global the_segment, the_pc
             hops_enabled = False
-            the_segment.pc = the_pc
-            ns = find_continuation_code_segment(min(256, max(sz, args.lfss or 48)))
-            if not ns:
-                ns = find_continuation_code_segment(min(256, sz))
+            the_segment.pc = hpc = the_pc
+            ns = find_hop_segment(sz)
             if not ns:
                 fatal(f"map memory exhausted while fitting function `{the_fragment.name}'")
             if jump:
                 emit_long_jump(ns.pc)
             hops_enabled = True
             the_segment.pc = the_pc
+            if the_trace:
+                the_trace.hops.append((hpc, sz, the_pc, ns.pc, ns.eaddr))
             if args.fragments and final_pass:
                 record_fragment_address(the_pc)
                 record_fragment_address(ns.pc)
@@ -656,6 +678,15 @@ def create_register_names(base):
         module_dict[k] = v
         globals()[k] = v
 
+def register_names():
+    '''Names published by create_register_names, whatever the rom.'''
+    return { "vPC", "vAC", "vACL", "vACH", "vLR", "vSP", "FAC",
+             "T0", "T1", "T2", "T3", "T4", "T5",
+             "LAX", "LAC", "FAS", "FAE", "SP" } \
+         | { f'R{i}' for i in range(0,24) } \
+         | { f'L{i}' for i in range(0,23) } \
+         | { f'F{i}' for i in range(0,22) }
+
 def new_globals():
     '''Return a pristine global symbol table to read .s/.o/.a files.'''
     global module_dict
@@ -740,8 +771,13 @@ def v(x):
     if the_module:
         the_module.symrefs[x] = the_pass
         if x in the_module.symdefs:
-            return the_module.symdefs[x]
+            r = the_module.symdefs[x]
+            if the_trace and x not in the_trace.reads:
+                the_trace.reads[x] = r
+            return r
     r = resolve(x)
+    if the_trace and x not in the_trace.reads:
+        the_trace.reads[x] = r
     if final_pass and r == None:
         error(f"undefined symbol '{x}'", dedup=True)
     return Unk(0xDEAD) if r == None else r
@@ -825,9 +861,14 @@ def label(sym, val=None, hop=None):
         referenced = False
         if sym in the_module.symrefs:
             referenced = (the_module.symrefs[sym] == the_pass)
+        if the_trace and sym not in the_trace.reads:
+            the_trace.refs.setdefault(sym, referenced)
         if the_fragment.cseg == 'CODE' and hop != 0 and not referenced:
             tryhop(hop or 12)
-        the_module.label(sym, v(val) if val != None else the_pc)
+        val = v(val) if val != None else the_pc
+        if the_trace:
+            the_trace.labels.append((sym, val))
+        the_module.label(sym, val)
 
 @vasm
 def pragma_option(opt):
@@ -2235,20 +2276,92 @@ module_dict['_BMOV'] = _MOVM
 
 # ------------- reading .s/.o/.a files
 
+def compile_cached(source, f):
+    '''Compiles python source from a .s/.o/.a or map file.
+       Code objects are marshalled in the cache directory
+       under a hash of the python version, file name, and source.
+       Any problem with the cache falls back to compile().'''
+    if not cachedir:
+        return compile(source, f, 'exec')
+    if isinstance(source, str):
+        source = source.encode()
+    h = hashlib.sha1(importlib.util.MAGIC_NUMBER)
+    h.update(sys.implementation.cache_tag.encode() + b'\0')
+    h.update(f.encode() + b'\0')
+    h.update(source)
+    cf = os.path.join(cachedir, h.hexdigest())
+    try:
+        with open(cf, 'rb') as fd:
+            c = marshal.loads(fd.read())
+        if isinstance(c, type(compile_cached.__code__)):
+            return c
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    c = compile(source, f, 'exec')
+    try:
+        os.makedirs(cachedir, exist_ok=True)
+        tmp = f"{cf}.{os.getpid()}"
+        with open(tmp, 'wb') as fd:
+            fd.write(marshal.dumps(c))
+        os.replace(tmp, cf)
+    except OSError as err:
+        debug(f"cannot write bytecode cache: {err}")
+    return c
+
+def exec_source(f, source, g):
+    '''Compiles and executes python source from a .s/.o/.a file'''
+    try:
+        c = compile_cached(source, f)
+    except SyntaxError as err:
+        fatal(str(err))
+    exec(c, g)
+
+def read_toc(f, s):
+    '''Returns the table of contents written by glink --ranlib at the
+       beginning of library s, and the length of its line. Returns None
+       when there is none or when the library changed since.'''
+    if not s.startswith(b'#glink-toc '):
+        return None
+    n = s.find(b'\n') + 1
+    try:
+        toc = json.loads(s[11:n].decode())
+    except ValueError:
+        return None
+    if toc.get('size') != len(s) - n:
+        debug(f"ignoring stale table of contents in '{f}'")
+        return None
+    return toc, n
+
 def read_file(f):
-    '''Reads a .s/.o/.a file in a pristine environment'''
+    '''Reads a .s/.o/.a file in a pristine environment.
+       The modules of a library with a table of contents are
+       only executed when the closure selects them.'''
     global the_module, the_fragment, new_modules, module_list
     debug(f"reading '{f}'")
-    with open(f, 'r') as fd:
+    with open(f, 'rb') as fd:
         s = fd.read()
-        try:
-            c = compile(s, f, 'exec')
-        except SyntaxError as err:
-            fatal(str(err))
+    toc = f.endswith(".a") and read_toc(f, s)
     the_module = None
     the_fragment = None
     new_modules = []
-    exec(c, new_globals())
+    if not toc:
+        exec_source(f, s, new_globals())
+    else:
+        g = None
+        toc, n = toc
+        for (offset, size, line, modules) in toc['chunks']:
+            source = s[n+offset:n+offset+size]
+            if modules is None:                    # depends on the link options
+                g = g or new_globals()
+                exec_source(f, b'\n' * line + source, g)
+                continue
+            chunk = Chunk(f, line + 1, source)
+            for (name, cpu, exports, imports, cimports) in modules:
+                code = [ ('EXPORT', sym) for sym in exports ] \
+                     + [ ('IMPORT', sym) for sym in imports ] \
+                     + [ tuple(tp) for tp in cimports ]
+                chunk.modules.append(Module(name, cpu, code, chunk=chunk))
+            new_modules += chunk.modules
     if len(new_modules) == 0:
         warning(f"file {f} did not define any module")
     if f.endswith(".a") or len(new_modules) > 1:
@@ -2260,6 +2373,140 @@ def read_file(f):
     module_list += new_modules
     new_modules = []
 
+def load_chunk(chunk):
+    '''Executes a library chunk whose modules were only known from
+       the table of contents. The modules it defines replace the
+       contents of the table of contents entries.'''
+    global the_module, the_fragment, new_modules
+    debug(f"loading '{chunk.fname}' from line {chunk.line}")
+    the_module = None
+    the_fragment = None
+    new_modules = []
+    exec_source(chunk.fname, b'\n' * (chunk.line - 1) + chunk.source, new_globals())
+    def entry(m):
+        return (m.name, m.cpu, m.exports, m.imports, m.cimports)
+    if list(map(entry, new_modules)) != list(map(entry, chunk.modules)):
+        fatal(f"table of contents of '{chunk.fname}' does not match line {chunk.line}"
+              f" (run glink --ranlib again)")
+    for (m, nm) in zip(chunk.modules, new_modules):
+        nm.library = m.library
+        nm.fname = m.fname
+        nm.used = m.used
+        m.__dict__.update(nm.__dict__)
+    new_modules = []
+
+def is_static_chunk(stmts, known):
+    '''Tells whether the modules defined by these statements do not
+       depend on the link options. The statements may only read names
+       they define, python builtins, and glink functions without side
+       effects, except in code fragments which run much later.'''
+    defined = set()
+    loaded = set()
+    funcs = {}
+    for node in ast.walk(ast.Module(body=stmts)):
+        if isinstance(node, ast.Name):
+            (loaded if isinstance(node.ctx, ast.Load) else defined).add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            defined.add(node.name)
+            funcs[node.name] = node
+        elif isinstance(node, ast.arg):
+            defined.add(node.arg)
+        elif isinstance(node, ast.alias):
+            defined.add((node.asname or node.name).split('.')[0])
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            defined.add(node.name)
+    if loaded - defined - known:
+        return False
+    # names read while executing the statements, including
+    # the functions they call, but not the code fragments.
+    loaded = set()
+    called = set()
+    todo = list(stmts)
+    while todo:
+        node = todo.pop()
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)):
+            todo += node.args.defaults + getattr(node, 'decorator_list', [])
+            continue
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+            loaded.add(node.id)
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            if node.func.id in funcs and node.func.id not in called:
+                called.add(node.func.id)
+                todo += funcs[node.func.id].body
+        todo += ast.iter_child_nodes(node)
+    unsafe = (set(module_dict) - { 'module', 'v' }) | { 'args', 'rominfo' }
+    return not (loaded & unsafe)
+
+def list_chunk_modules(f, line, code):
+    '''Executes a static library chunk and returns the table of
+       contents entries of the modules it defines, or None.'''
+    modules = []
+    def module(code=None, name=None, cpu=None):
+        exports = [ tp[1] for tp in code if tp[0] == 'EXPORT' ]
+        imports = [ tp[1] for tp in code if tp[0] == 'IMPORT' and len(tp) == 2 ]
+        cimports = [ tp for tp in code if tp[0] == 'IMPORT' and len(tp) > 3 and tp[2] == 'IF' ]
+        modules.append((name, cpu, exports, imports, cimports))
+    g = new_globals()
+    g['module'] = module
+    try:
+        exec(code, g)
+        json.dumps(modules)
+    except Exception as err:
+        debug(f"{f}:{line}: cannot list modules ({err})")
+        return None
+    if not modules or not all(m[0] for m in modules):
+        return None
+    return modules
+
+def ranlib(f):
+    '''Writes a table of contents at the beginning of library f.
+       The library is split after each top level call such as scope()
+       or module(). The table records the byte offset of each chunk,
+       and the name, cpu, exports, and imports of its modules. Chunks
+       whose modules depend on the link options have no entries
+       and are executed whenever the library is read.'''
+    with open(f, 'rb') as fd:
+        s = fd.read()
+    if s.startswith(b'#glink-toc '):
+        s = s[s.find(b'\n')+1:]
+    try:
+        stmts = ast.parse(s, f).body
+    except SyntaxError as err:
+        fatal(str(err))
+    offsets = [0, 0]                               # offset of each line
+    for l in s.splitlines(keepends=True):
+        offsets.append(offsets[-1] + len(l))
+    def start(stmt):
+        return min([stmt.lineno] + [d.lineno for d in getattr(stmt, 'decorator_list', [])])
+    g = new_globals()
+    known = set(g) | set(g['__builtins__']) | register_names()
+    toc = []
+    first, line = 0, 1
+    for (i, stmt) in enumerate(stmts):
+        if i + 1 == len(stmts):
+            nline = len(offsets) - 1
+        elif isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Call) \
+             and start(stmts[i+1]) > getattr(stmt, 'end_lineno', stmt.lineno):
+            nline = start(stmts[i+1])
+        else:
+            continue
+        source = s[offsets[line]:offsets[nline]]
+        try:
+            code = compile(b'\n' * (line - 1) + source, f, 'exec')
+        except SyntaxError:
+            continue                               # keep going with the next statement
+        modules = None
+        if is_static_chunk(stmts[first:i+1], known):
+            modules = list_chunk_modules(f, line, code)
+        else:
+            debug(f"{f}:{line}: modules depend on link options")
+        toc.append((offsets[line], len(source), line, modules))
+        first, line = i + 1, nline
+    toc = json.dumps({ 'size': len(s), 'chunks': toc }, separators=(',',':'))
+    with open(f, 'wb') as fd:
+        fd.write(b'#glink-toc ' + toc.encode() + b'\n')
+        fd.write(s)
+
 def search_file(fn, path):
     '''Searches a file along a given path.'''
     for d in path:
@@ -2281,7 +2528,7 @@ def read_map(mn, overlays = None):
     if not fn:
         fatal(f"cannot find linker map '{mn}'")
     with open(fn, 'r') as fd:
-        exec(compile(fd.read(), fn, 'exec'), globals())
+        exec(compile_cached(fd.read(), fn), globals())
     if not map_segments:
         fatal(f"map '{mn}' does not define 'map_segments'")
     if not map_modules:
@@ -2293,7 +2540,7 @@ def read_map(mn, overlays = None):
         if not os.access(fn, os.R_OK):
             fatal(f"cannot load map overlay '{ov}'")
         with open(fn, 'r') as fd:
-            exec(compile(fd.read(), fn, 'exec'), globals())
+            exec(compile_cached(fd.read(), fn), globals())
 
 def read_interface():
     '''Read `interface.json' as known symbols.'''
@@ -2341,20 +2588,22 @@ def read_rominfo(rom):
 
 # ------------- compute code closure from import/export information
 
-def find_exporters(sym):
-    elist = []
-    # collect all modules that export sym
+def index_exporters():
+    '''Map each symbol to the modules that export it, in module_list order.
+       A symbol that no module exports maps to the first input file
+       (not a library) that has a common named sym.'''
+    index = {}
     for m in module_list:
-        if sym in m.exports:
-            elist.append(m)
-    if not elist:
-        # otherwise find an input file(not a library) that has a common named sym.
-        for m in module_list:
-            if not m.library:
-                for f in m.code:
-                    if f.cseg == 'COMMON' and f.name == sym:
-                        return [ m ]
-    return elist
+        for sym in m.exports:
+            elist = index.setdefault(sym, [])
+            if not elist or elist[-1] is not m:
+                elist.append(m)
+    for m in module_list:
+        if not m.library:
+            for f in m.code:
+                if f.cseg == 'COMMON' and f.name not in index:
+                    index[f.name] = [ m ]
+    return index
 
 def measure_data_fragment(m, frag):
     global the_module, the_fragment, the_pc
@@ -2397,19 +2646,20 @@ def measure_fragments(m):
     the_module = None
     the_fragment = None
 
-def check_conditional_import(tp):
-    if len(tp) < 4 or tp[3] != 'IF':
-        return False
-    for sym in tp[4:]:
-        if not sym in exporters:
-            return False
-    return True
-
 def compute_closure():
     global module_list, exporters
     # compute closure from start symbol
+    index = index_exporters()
     implist = [ args.e ] + args.r
-    cimplist = []
+    waiting = {}                                   # symbol -> conditional imports waiting for its export
+    ready = []                                     # conditional imports whose conditions are all exported
+    corder = 0
+    def check_conditional_import(ci):              # ci is (order, module, symbol, conditions)
+        for sym in ci[3]:
+            if sym not in exporters:
+                waiting.setdefault(sym, []).append(ci)
+                return
+        ready.append(ci)
     for sym in implist:
         if sym in exporters:
             pass
@@ -2417,8 +2667,7 @@ def compute_closure():
             pass
         else:
             e = None
-            elist = find_exporters(sym)
-            for m in elist:
+            for m in index.get(sym, []):
                 if m.library:                      # rules for selecting one of many library
                     if e and not e.library:        # modules exporting a same required symbol:
                         pass                       # -- cannot override a non-library module
@@ -2432,7 +2681,13 @@ def compute_closure():
                     e = m
             if e and not e.used:
                 debug(f"including module '{e.fname}' for symbol '{sym}'")
+                if e.chunk:                        # -- load it from the library
+                    load_chunk(e.chunk)
                 e.used = True
+                released = []
+                for sym in e.exports:              # find conditional imports waiting for these exports
+                    if sym not in exporters:
+                        released += waiting.pop(sym, [])
                 for sym in e.exports:              # register all symbols exported by the selected module
                     if sym in exporters:           # -- warn about possible conflicts
                         error(f"symbol '{sym}' is exported by both '{e.fname}' and '{exporters[sym].fname}'", dedup=True)
@@ -2441,15 +2696,15 @@ def compute_closure():
                 measure_fragments(e)               # -- check all fragment code, compute missing lengths or exports
                 for sym in e.imports:              # -- add all its imports to the list of required imports
                     implist.append(sym)
-                for tp in e.cimports:              # -- process conditional imports
-                    cimplist.append((e, *tp))
-                if cimplist:
-                    for i in range(len(cimplist)):
-                        tp = cimplist[i]
-                        if check_conditional_import(tp):
-                            tp[0].imports.append(tp[2])
-                            implist.append(tp[2])
-                            del cimplist[i]
+                for ci in released:                # -- process conditional imports
+                    check_conditional_import(ci)
+                for tp in e.cimports:
+                    corder += 1
+                    check_conditional_import((corder, e, tp[1], tp[3:]))
+                for ci in sorted(ready):           # -- in the order they were seen
+                    ci[1].imports.append(ci[2])
+                    implist.append(ci[2])
+                ready.clear()
     # recompute module_list
     nml = []
     for m in module_list:
@@ -2499,6 +2754,135 @@ class Stop(Exception):
     def __init__(self, msg):
         self.msg = msg
 
+class Trace:
+    '''Inputs and effects of assembling a fragment in a pass.
+       The fragment gives the same result in the next pass when it
+       starts at the same place, reads the same label values, and
+       hops to the same places. Replaying its effects is then much
+       faster than executing it again.'''
+    __slots__ = ('pc', 'eaddr', 'hops_enabled', 'short_function', 'genlabel',
+                 'reads', 'refs', 'hops', 'labels', 'result')
+    def __init__(self):
+        self.pc = the_pc                       # inputs
+        self.eaddr = the_segment.eaddr
+        self.hops_enabled = hops_enabled
+        self.short_function = short_function
+        self.genlabel = genlabel_counter
+        self.reads = {}                        # -- value of labels on first read
+        self.refs = {}                         # -- labels referenced before label()
+        self.hops = []                         # -- hops, checked by replay()
+        self.labels = []                       # effects: label definitions
+        self.result = None                     # -- final pc, hops, short, genlabel
+    def finish(self):
+        self.result = (the_pc, hops_enabled, short_function, genlabel_counter)
+    def matches(self, m):
+        if (self.pc, self.eaddr, self.hops_enabled, self.short_function, self.genlabel) != \
+           (the_pc, the_segment.eaddr, hops_enabled, short_function, genlabel_counter):
+            return False
+        for (sym, val) in self.reads.items():
+            if (m.symdefs[sym] if sym in m.symdefs else resolve(sym)) != val:
+                return False
+        for (sym, referenced) in self.refs.items():
+            if (m.symrefs.get(sym) == the_pass) != referenced:
+                return False
+        return True
+    def replay(self, m):
+        '''Replays the effects of assembling the fragment. Returns False
+           without effects when a hop would land somewhere else.'''
+        global the_segment, the_pc, hops_enabled, short_function, genlabel_counter
+        if self.hops:
+            saved = segment_index.save()
+            segment = the_segment
+            for (hpc, sz, jpc, npc, neaddr) in self.hops:
+                the_segment.pc = hpc
+                try:
+                    ns = find_hop_segment(sz)
+                except Exception as err:
+                    fatal(str(err), exc=True)
+                if not ns or ns.pc != npc or ns.eaddr != neaddr:
+                    segment_index.restore(saved)
+                    the_segment = segment
+                    return False
+                the_segment.pc = jpc
+                the_segment = ns
+        for sym in self.reads:
+            m.symrefs[sym] = the_pass
+        for (sym, val) in self.labels:
+            m.label(sym, val)
+        (the_pc, hops_enabled, short_function, genlabel_counter) = self.result
+        return True
+
+class SegmentIndex:
+    '''Free space index for find_segment().
+       Carving a segment only inserts its pieces right after it, so the
+       segment list is the list of the map segments, each one replaced
+       by its pieces. For each flag letter, a tree over the map segments
+       gives the largest free space of their pieces. Free space only
+       shrinks, so the tree is refreshed when the pieces are visited.'''
+    def __init__(self, segments):
+        self.pieces = [ [s] for s in segments ]
+        self.n = 1
+        while self.n < len(segments):
+            self.n += self.n
+        self.trees = { c : [-1] * (2 * self.n) for c in "CcDd" }
+        for k in range(len(segments)):
+            self.refresh(k)
+    def segments(self):
+        return [ s for ps in self.pieces for s in ps ]
+    def insert(self, k, s, ns):
+        ps = self.pieces[k]
+        ps.insert(ps.index(s) + 1, ns)
+    def refresh(self, k):
+        free = max(s.eaddr - s.pc for s in self.pieces[k])
+        for c in self.pieces[k][0].flags:
+            if c in self.trees:
+                t = self.trees[c]
+                i = self.n + k
+                t[i] = free
+                while i > 1:
+                    i >>= 1
+                    t[i] = max(t[i+i], t[i+i+1])
+    def first(self, c, k, size):
+        '''Returns the first map segment after k whose pieces
+           may have size free bytes and flag c, or None.'''
+        t = self.trees[c]
+        i = self.n + k
+        while True:
+            if t[i] >= size:
+                while i < self.n:
+                    i += i
+                    if t[i] < size:
+                        i += 1
+                return i - self.n
+            while i & 1:
+                i >>= 1
+            if i == 0:
+                return None
+            i += 1
+    def candidates(self, flags, size):
+        '''Yields the segments that may have size free bytes and one
+           of the given flags, with their map segment, in list order.'''
+        k = 0
+        while k < len(self.pieces):
+            ks = [ self.first(c, k, size) for c in flags ]
+            ks = [ x for x in ks if x != None ]
+            if not ks:
+                return
+            k = min(ks)
+            for s in self.pieces[k]:
+                yield (k, s)
+            self.refresh(k)
+            k += 1
+    def save(self):
+        return ([ list(ps) for ps in self.pieces ],
+                [ (s, s.eaddr, s.pc, s.nbss) for ps in self.pieces for s in ps ])
+    def restore(self, saved):
+        (self.pieces, state) = saved
+        for (s, eaddr, pc, nbss) in state:
+            s.eaddr, s.pc, s.nbss = eaddr, pc, nbss
+        for k in range(len(self.pieces)):
+            self.refresh(k)
+
 def aligned(addr, align):
     if align and align > 1:
         addr = align * ((addr + align - 1) // align)
@@ -2514,7 +2898,12 @@ def find_segment(size, cseg, align=1, firstgo=True):
     amax = the_fragment.amax
     aoff = the_fragment.aoff
     nohop = the_fragment.nohop or iscode
-    for (i,s) in enumerate(segment_list):
+    # the index skips segments that cannot fit, except for hard placement
+    if amin != None and amax == None:
+        candidates = segment_index.candidates(tflag, 0)
+    else:
+        candidates = segment_index.candidates(tflag if amin != None else tflag[0], size)
+    for (k,s) in candidates:
         # check flags
         if not tflag[0] in s.flags:
             if amin == None or not tflag[1] in s.flags:
@@ -2556,15 +2945,14 @@ def find_segment(size, cseg, align=1, firstgo=True):
         if addr > s.pc or s.nbss * tnbss < 0:
             ns = Segment(addr, s.eaddr, s.flags)
             s.eaddr = addr
-            segment_list.insert(i+1, ns)
+            segment_index.insert(k, s, ns)
             s = ns
-            i = i+1
         # make sure code segment does not extend beyond page boundary
         epage = (addr | 0xff) + 1
         if iscode and s.eaddr > epage:
             ns = Segment(epage, s.eaddr, s.flags)
             s.eaddr = epage
-            segment_list.insert(i+1, ns)
+            segment_index.insert(k, s, ns)
         # mark nbss
         s.nbss = s.nbss or tnbss
         # validate and return
@@ -2584,6 +2972,11 @@ def find_continuation_code_segment(size):
     return find_segment(size, cseg='CODE', firstgo=True) \
         or find_segment(size, cseg='CODE', firstgo=False)
 
+def find_hop_segment(sz):
+    # this is called to find where a code fragment hops
+    return find_continuation_code_segment(min(256, max(sz, args.lfss or 48))) \
+        or find_continuation_code_segment(min(256, sz))
+
 def find_first_code_segment(frag, firstgo=True):
     global the_segment, hops_enabled, short_function
     funcsize = frag.size
@@ -2611,7 +3004,7 @@ def find_first_code_segment(frag, firstgo=True):
     return the_segment
     
 def assemble_fragments(firstgo, predicate=None):
-    global the_module, the_fragment, the_segment, the_pc, hops_enabled
+    global the_module, the_fragment, the_segment, the_pc, hops_enabled, the_trace
     for m in module_list:
         the_module = m
         for frag in m.code:
@@ -2634,13 +3027,22 @@ def assemble_fragments(firstgo, predicate=None):
             the_pc = the_segment.pc
             if args.fragments and final_pass:
                 record_fragment_address(the_pc)
-            try:
-                if isinstance(frag.func, (builtins.bytes, bytearray)):
-                    emit(*frag.func)
-                else:
-                    frag.func()
-            except Exception as err:
-                fatal(str(err), exc=True)
+            replayed = frag.trace and not final_pass \
+                and frag.trace.matches(m) and frag.trace.replay(m)
+            if not replayed:
+                frag.trace = None
+                the_trace = Trace() if not final_pass else None
+                try:
+                    if isinstance(frag.func, (builtins.bytes, bytearray)):
+                        emit(*frag.func)
+                    else:
+                        frag.func()
+                except Exception as err:
+                    fatal(str(err), exc=True)
+                if the_trace:
+                    the_trace.finish()
+                    frag.trace = the_trace
+                the_trace = None
             the_segment.pc = the_pc
             frag.passed = the_pass
             if args.fragments and final_pass:
@@ -2680,11 +3082,12 @@ def make_segments():
     return segments
 
 def run_pass():
-    global the_pass, the_module, the_fragment
+    global the_pass, the_module, the_fragment, the_trace
     global labelchange_counter, genlabel_counter
-    global segment_list, symdefs
+    global segment_list, segment_index, symdefs
     # initialize
     segment_list = make_segments()
+    segment_index = SegmentIndex(segment_list)
     the_pass += 1
     labelchange_counter = 0
     genlabel_counter = 0
@@ -2715,6 +3118,7 @@ def run_pass():
         # -- just to be sure
         assemble_fragments(False)
     except Stop as stop:
+        the_trace = None
         if final_pass or not labelchange_counter:
             fatal(stop.msg)
         elif args.d >= 2:
@@ -2722,6 +3126,7 @@ def run_pass():
     # cleanup
     the_module = None
     the_fragment = None
+    segment_list = segment_index.segments()
 
 def run_passes():
     global final_pass
@@ -2955,12 +3360,15 @@ def print_segments():
 
 def glink(argv):
     '''Main entry point'''
-    global lccdir, args, symdefs, module_list
+    global lccdir, cachedir, args, symdefs, module_list
     try:
         # Obtain LCCDIR
         lccdir = os.path.dirname(os.path.realpath(__file__))
         lccdir = os.getenv("LCCDIR", lccdir)
 
+        # Obtain bytecode cache directory (no cache unless GLINK_CACHE is set)
+        cachedir = os.getenv("GLINK_CACHE")
+
         ## Parse arguments
         parser = argparse.ArgumentParser(
             conflict_handler='resolve',
@@ -2997,7 +3405,10 @@ def glink(argv):
                 overlay name starts with './'.  Use options --info to
                 learn more about a map and its default overlays.  Note
                 that glcc pragmas (see <gigatron/pragmas.h) are
-                preferred over custom overlay files.
+                preferred over custom overlay files.  When environment
+                variable GLINK_CACHE names a directory, compiled python
+                code is cached there. Nothing is ever removed from this
+                directory.
             ''')
         parser.add_argument('files', type=str, nargs='*',
                             help='input files')
@@ -3019,6 +3430,9 @@ def glink(argv):
                             help='print the segment list derived from map and pragmas')
         parser.add_argument('-V', "--version", action='store_true',
                             help='report glcc/glink version')
+        parser.add_argument('--ranlib', action='store_true',
+                            help='write a table of contents at the beginning of the .a files, '
+                            'so that glink only compiles the library modules it needs')
         parser.add_argument('-l', type=str, action='append', metavar='LIB',
                             help='library files. -lxxx searches for libxxx.a')
         parser.add_argument('-L', type=str, action='append', metavar='LIBDIR',
@@ -3070,6 +3484,12 @@ def glink(argv):
 
         args = parser.parse_args(argv)
 
+        # a table of contents does not depend on the rom, cpu, or map
+        if args.ranlib:
+            for f in args.files or []:
+                ranlib(f)
+            return 0
+
         # process args
         read_rominfo(args.rom)
         args.cpu = args.cpu or romcpu or 5
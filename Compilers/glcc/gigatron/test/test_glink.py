@@ -0,0 +1,195 @@
+import importlib.util
+import pathlib
+import random
+import sys
+
+import pytest
+
+GIGATRON_DIR = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(GIGATRON_DIR))  # glink imports glccver
+
+
+def _load():
+    """A fresh glink module: glink keeps the state of a link in globals"""
+    spec = importlib.util.spec_from_file_location(
+        "glink", GIGATRON_DIR / "glink.py"
+    )
+    glink = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(glink)
+    return glink
+
+
+def _module(name, exports, imports=(), cimports=(), body="RET()"):
+    """Source of a module with a code fragment for each export"""
+    source, code = "", []
+    for i, sym in enumerate(exports):
+        source += f"def code{i}():\n    label({sym!r})\n    {body}\n\n"
+        code += [f"('EXPORT', {sym!r})", f"('CODE', {sym!r}, code{i})"]
+    code += [f"('IMPORT', {sym!r})" for sym in imports]
+    code += [f"('IMPORT', {sym!r}, 'IF', {cond!r})" for sym, cond in cimports]
+    return source + f"module(code=[{', '.join(code)}], name={name!r})\n\n"
+
+
+def _link(tmp_path, *argv, glink=None):
+    """Link into out.gt1, return the glink module and the output"""
+    glink = glink or _load()
+    out = tmp_path / "out.gt1"
+    argv = [*map(str, argv), "-L", str(tmp_path), "-r", "_gt1exec"]
+    assert glink.glink(argv + ["-o", str(out)]) == 0
+    return glink, out.read_bytes()
+
+
+def _exporters(glink):
+    return {
+        sym: m.fname for sym, m in glink.exporters.items() if sym != "_gt1exec"
+    }
+
+
+@pytest.fixture
+def program(tmp_path, monkeypatch):
+    """A main module and a library where modules import each other"""
+    monkeypatch.delenv("GLINK_CACHE", raising=False)
+    main = tmp_path / "main.s"
+    main.write_text(_module("main.s", ["_start"], imports=["a"]))
+    (tmp_path / "libx.a").write_text(
+        _module("a.s", ["a"], ["b"], [("d", "b"), ("e", "c")])
+        + _module("b.s", ["b"])
+        + _module("c.s", ["c"], ["missing"])
+        + _module("d.s", ["d"])
+        + _module("e.s", ["e"])
+    )
+    (tmp_path / "liby.a").write_text(_module("b2.s", ["b"]))
+    return main
+
+
+CLOSURE = {
+    "_start": "main.s",
+    "a": "libx.a(a.s)",
+    "b": "libx.a(b.s)",
+    "d": "libx.a(d.s)",
+}
+
+
+def test_closure(tmp_path, program):
+    """Imports are followed from module to module, conditional ones
+    once their condition is exported, and the first library wins"""
+    glink, _ = _link(tmp_path, program, "-lx", "-ly")
+    assert _exporters(glink) == CLOSURE
+    glink, _ = _link(tmp_path, program, "-ly", "-lx")
+    assert _exporters(glink)["b"] == "liby.a(b2.s)"
+
+
+def test_undefined(tmp_path, program, capsys):
+    """A symbol that no module exports is an error"""
+    glink = _load()
+    argv = [str(program), "-L", str(tmp_path), "-lx", "-r", "c"]
+    assert glink.glink(argv + ["-o", str(tmp_path / "out.gt1")]) == 1
+    assert (
+        "undefined symbol 'missing' imported by 'libx.a(c.s)'"
+        in capsys.readouterr().err
+    )
+
+
+def _ranlib(lib):
+    assert _load().glink(["--ranlib", str(lib)]) == 0
+    assert lib.read_bytes().startswith(b"#glink-toc ")
+
+
+@pytest.mark.parametrize("toc", ["fresh", "stale", "none"])
+def test_table_of_contents(tmp_path, program, toc):
+    """Linking with a library gives the same result whether its
+    table of contents is up to date, out of date, or missing"""
+    lib = tmp_path / "libx.a"
+    if toc != "none":
+        _ranlib(lib)
+    if toc == "stale":
+        # The library changes after glink --ranlib
+        source = lib.read_bytes()
+        lib.write_bytes(source.replace(b"'b')\n    RET", b"'b')\n    LDI(1);RET"))
+    glink, gt1 = _link(tmp_path, program, "-lx")
+    assert _exporters(glink) == CLOSURE
+    if toc != "none":
+        lib.write_bytes(lib.read_bytes().split(b"\n", 1)[1])  # Remove it
+    assert _link(tmp_path, program, "-lx")[1] == gt1
+
+
+def test_table_of_contents_mismatch(tmp_path, program, capsys):
+    """A table of contents that lies about a module is fatal"""
+    lib = tmp_path / "libx.a"
+    _ranlib(lib)
+    lib.write_bytes(lib.read_bytes().replace(b"'b.s'", b"'q.s'"))
+    with pytest.raises(SystemExit):
+        _link(tmp_path, program, "-lx")
+    assert "(run glink --ranlib again)" in capsys.readouterr().err
+
+
+def test_replay(tmp_path, monkeypatch):
+    """Replaying fragments in later passes gives the same output"""
+    monkeypatch.delenv("GLINK_CACHE", raising=False)
+    names = [f"f{i}" for i in range(12)]
+    calls = ";".join(f"_CALLJ({name!r})" for name in names)
+    main = tmp_path / "main.s"
+    main.write_text(_module("main.s", ["_start"], names, body=calls))
+    body = "PUSH();" + "LDW(R8);ADDI(1);STW(R8);" * 12 + "POP();RET()"
+    lib = "".join(_module(f"{name}.s", [name], body=body) for name in names)
+    (tmp_path / "libf.a").write_text(lib)
+
+    glink = _load()
+    replayed = []
+    replay = glink.Trace.replay
+    monkeypatch.setattr(
+        glink.Trace,
+        "replay",
+        lambda trace, m: replayed.append(trace) or replay(trace, m),
+    )
+    _, gt1 = _link(tmp_path, main, "-lf", "-rom", "v5a", glink=glink)
+    assert replayed
+
+    glink = _load()
+    monkeypatch.setattr(glink.Trace, "matches", lambda trace, m: False)
+    assert _link(tmp_path, main, "-lf", "-rom", "v5a", glink=glink)[1] == gt1
+
+
+def _fits(s, flags, size):
+    return any(c in s.flags for c in flags) and s.eaddr - s.pc >= size
+
+
+def test_segment_index():
+    """The index finds the same segments as a scan of the list"""
+    glink = _load()
+    rng = random.Random(1)
+    for _ in range(20):
+        segments = []
+        for _ in range(rng.randrange(1, 40)):
+            saddr = rng.randrange(0, 0x10000, 0x100)
+            flags = rng.choice(["CDH", "cDH", "CD", "Cd", "D", "c"])
+            segments.append(glink.Segment(saddr, saddr + 0x100, flags))
+        index = glink.SegmentIndex(segments)
+        for _ in range(100):
+            # Use some of a piece, or carve a new piece out of it
+            k = rng.randrange(len(index.pieces))
+            s = rng.choice(index.pieces[k])
+            addr = rng.randint(s.pc, s.eaddr)
+            if rng.random() < 0.5:
+                s.pc = addr
+            else:
+                ns = glink.Segment(addr, s.eaddr, s.flags)
+                s.eaddr = addr
+                index.insert(k, s, ns)
+            flags = rng.choice(["C", "Cc", "D", "Dd"])
+            size = rng.randrange(0, 0x101)
+            expected = [s for s in index.segments() if _fits(s, flags, size)]
+            found = [s for _, s in index.candidates(flags, size)]
+            assert [s for s in found if _fits(s, flags, size)] == expected
+        # Once refreshed, the trees give exactly the first fitting segment
+        for k in range(len(index.pieces)):
+            index.refresh(k)
+        for c in "CcDd":
+            for size in (0, 1, 0x40, 0x100):
+                for k in range(len(index.pieces)):
+                    first = [
+                        j
+                        for j in range(k, len(index.pieces))
+                        if any(_fits(s, c, size) for s in index.pieces[j])
+                    ]
+                    assert index.first(c, k, size) == (first + [None])[0]
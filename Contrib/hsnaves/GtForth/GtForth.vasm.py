@@ -265,7 +265,7 @@ def extend_callback(gt1, ins):
     size = segment[1]
     contents = segment[3]
     if len(contents) + len(ins) > size or len(contents) >= size:
-        new_segment = (base + 256, size, {}, [])
+        new_segment = SEGMENT(base + 256, size)
         gt1.append(new_segment)
 
 def pack_segments_factory(base, size):
@@ -317,7 +317,7 @@ def pack_segments_factory(base, size):
                 if cur_page in used_pages:
                     raise RuntimeError("page overlap at 0x%04X" % cur_base)
 
-                new_segments.append([cur_base, size, {}, []])
+                new_segments.append(SEGMENT(cur_base, size))
                 selected = new_segments[-1]
                 cur_base += 256
 
@@ -102,12 +102,8 @@ class _Emulator:
         This requires that an assembly script has already been executed.
         """
 
-        def gen_rom_data():
-            for opcode, operand in zip(asm._rom0, asm._rom1):
-                yield opcode
-                yield operand
-
-        rom_data = bytearray(gen_rom_data())
+        # asm keeps the ROM image interleaved, exactly as in a .rom file
+        rom_data = asm._rom[: 2 * asm._romSize]
         _gtemu.ffi.buffer(ROM)[0 : len(rom_data)] = rom_data
 
     def reset(self):
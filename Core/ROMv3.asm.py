@@ -3338,6 +3338,7 @@ define('vAC',        vAC)
 define('vACH',       vAC+1)
 define('vLR',        vLR)
 define('vSP',        vSP)
+define('vTicks',     vTicks)    # Not in interface.json, for timing analysis
 define('romType',    romType)
 define('sysFn',      sysFn)
 for i in range(8):
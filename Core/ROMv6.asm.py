@@ -6051,6 +6051,7 @@ define('vACH',       vAC+1)
 define('vLR',        vLR)
 define('vSP',        vSP)
 define('vTmp',       vTmp)      # Not in interface.json
+define('vTicks',     vTicks)    # Not in interface.json, for timing analysis
 define('romType',    romType)
 define('sysFn',      sysFn)
 for i in range(8):
@@ -9,8 +9,11 @@
 # .asm.py extension. During assembly we produce .lst files as a program
 # listing in a more conventional notation.
 
+import ast
+import asmbase
 import inspect
 import json
+import os
 from os.path import basename, splitext, relpath
 import re
 import sys
@@ -176,6 +179,14 @@ def pc():
   """Current ROM address"""
   return _romSize
 
+def cycle(n):
+  """Declare the cycle at which the next instruction executes (see _checkTiming)"""
+  _cycles[_romSize] = n
+
+def landing(n):
+  """Declare the cycle at which the next instruction, an indirect jump, lands"""
+  _landings[_romSize] = n
+
 def zpByte(len=1):
   """Allocate one or more bytes from the zero-page"""
   global _zpSize
@@ -223,18 +234,40 @@ def trampoline():
   C('+-----------------------------------+')
   align(1, 0x100)
 
+def ldBytes(data):
+  """Emit ROM table data, with a trampoline() at the end of every page
+
+  Same as ld(byte) for every byte, each time followed by a trampoline()
+  when the page offset reaches 251. But complete pages go in one step."""
+  global _romSize
+  data = memoryview(bytes(data))
+  while len(data) > 0:
+    n = (250 - pc()) % 256 + 1          # Words until page offset 251
+    chunk, data = data[:n], data[n:]
+    start, end = _romSize, _romSize + len(chunk)
+    if has(_listing) or end > _maxRomSize:
+      for byte in chunk:                # Slow path for listing and errors
+        ld(byte)
+    else:
+      _rom[2*start:2*end:2] = bytes([_opLD|_ea0DregAC|_busD]) * len(chunk)
+      _rom[2*start+1:2*end:2] = chunk
+      _romSize = end
+    if len(chunk) == n:
+      trampoline()
+
 def end():
   """Resolve symbols and write output"""
   for name, where in _refsL:
     if name in _symbols:
-      _rom1[where] += _symbols[name] # Addition allows some label tricks
-      _rom1[where] &= 255
+      where = 2*where+1 # Operand byte of the ROM word
+      _rom[where] = (_rom[where] + _symbols[name]) & 255 # Addition allows some label tricks
     else:
       highlight('Error: Undefined symbol %s' % repr(name))
 
   for name, where in _refsH:
     if name in _symbols:
-      _rom1[where] += _symbols[name] >> 8
+      where = 2*where+1
+      _rom[where] = (_rom[where] + (_symbols[name] >> 8)) & 255
     else:
       highlight('Error: Undefined symbol %s' % repr(name))
 
@@ -244,13 +277,56 @@ def end():
 #       Behind the scenes
 #------------------------------------------------------------------------
 
-# Module variables because I don't feel like making a class
-_romSize, _maxRomSize, _zpSize = 0, 0, 1
-_symbols, _refsL, _refsH = {}, [], []
-_labels = {} # Inverse of _symbols, but only when made with label(). For disassembler
-_comments = {}
-_rom0, _rom1, _linenos = [], [], []
-_listing, _listingSource, _lineno = None, None, None
+# Module variables because I don't feel like making a class. They hold
+# the state of the current Assembler (see below), and are initialized there.
+#
+# _romSize, _maxRomSize, _zpSize
+# _symbols, _refsL, _refsH
+# _labels       Inverse of _symbols, but only when made with label(). For disassembler
+# _comments
+# _cycles       Address -> cycle number, as declared with cycle()
+# _landings     Address of an indirect jump -> cycle number, as declared with landing()
+# _linenos      Address -> source line, only for words emitted while listing
+# _offsets      Address -> bytecode offset in the listing frame, see _resolveLinenos()
+# _rom          The ROM image is preallocated as 64K words, with opcode and operand
+#               interleaved exactly as in the .rom file. The file is then written as
+#               one slice of this buffer.
+# _rom0, _rom1  Strided views into _rom
+# _listing, _listingSource, _lineno
+# _defined      See defined()
+_stateNames = [
+  '_romSize', '_maxRomSize', '_zpSize',
+  '_symbols', '_refsL', '_refsH',
+  '_labels', '_comments', '_cycles', '_landings', '_linenos', '_offsets',
+  '_rom', '_rom0', '_rom1',
+  '_listing', '_listingSource', '_lineno', '_defined',
+]
+
+class Assembler(asmbase.State):
+  """Complete assembler state for building one ROM image
+
+  All functions in this module act on the current assembler. An
+  Assembler becomes current while used as context manager, so several
+  ROM images can be assembled in one process, one after the other:
+
+    with Assembler(defines={'WITH_512K_BOARD': 1}):
+      runpy.run_path('Core/dev.asm.py')
+
+  The initial assembler takes its defines from the command line.
+  """
+  _globals, _names = globals(), _stateNames
+
+  def __init__(self, defines=None):
+    rom = bytearray(2*0x10000)
+    super().__init__({
+      '_romSize': 0, '_maxRomSize': 0, '_zpSize': 1,
+      '_symbols': {}, '_refsL': [], '_refsH': [],
+      '_labels': {}, '_comments': {}, '_cycles': {}, '_landings': {},
+      '_linenos': {}, '_offsets': {},
+      '_rom': rom, '_rom0': memoryview(rom)[0::2], '_rom1': memoryview(rom)[1::2],
+      '_listing': None, '_listingSource': None, '_lineno': None,
+      '_defined': dict(defines or {}),
+    })
 
 # General instruction layout
 _maskOp   = 0b11100000
@@ -326,6 +402,48 @@ _jS  = 7 << 2
 
 def _assemble(op, val, to=AC, addr=None, warn=True):
   """Assemble and emit one instruction"""
+
+  # First operand can be optional
+  if val.__class__ is list:
+    val, addr = None, val
+
+  # Fast path: look up the encoding for this shape of operands
+  vShape = val if val is None or val is AC or val is IN else val.__class__
+  if addr is None:
+    aShape = None
+  elif len(addr) == 1:
+    aShape = _shape(addr[0]),
+  else:
+    aShape = _shape(addr[0]), _shape(addr[-1])
+  encoding = _encodings.get((op, vShape, to, aShape))
+
+  if encoding:
+    opcode, source, risky = encoding
+    if   source is _fromVal:   d = val
+    elif source is _fromLabel: d = lo(val)
+    elif source is _fromAddr:  d = addr[-1]
+    else:                      d = 0
+  else:
+    # Slow path for everything else, including the error cases
+    opcode, d = _encode(op, val, to, addr)
+    risky = _isRisky(op, opcode)
+
+  _emit(opcode, d & 255)
+
+  # Warning for conditional branches with a target address from RAM. The (unverified) danger is
+  # that the ALU is calculating `-A' (for the condition decoder) as L+R+1, with L=0 and R=~A. But B
+  # is also an input to R and comes from memory. The addressing mode is [D], which requires high
+  # EH and EL, and this is slower when the diodes are forward biased from the previous instruction.
+  # Therefore R might momentarily glitch while B changes value and the AND/OR layers in the 74153
+  # multiplexer resettles. Such a glitch then potentially ripples all the way through two 74283
+  # adders and the control unit's 74153. This all depends on the previous instruction's addressing
+  # mode and the values of AC and [D], which we can't know with static analysis.
+  # See also https://github.com/kervinck/gigatron-rom/issues/78
+  if warn and risky:
+    highlight('Warning: %04x : large propagation delay (conditional branch with RAM on bus)' % _romSize)
+
+def _encode(op, val, to=AC, addr=None):
+  """Decode operands into an (opcode, operand) pair"""
   d, mode, bus = 0, 0, 0                                # [D] (default)
 
   # First operand can be optional
@@ -362,73 +480,77 @@ def _assemble(op, val, to=AC, addr=None, warn=True):
   elif isinstance(val, (_bytes, _str)): d = lo(_str(val)) # Convenient for branch instructions
   elif isinstance(val, int): d = val
 
-  _emit(op | mode | bus, d & 255)
+  return op | mode | bus, d
+
+def _isRisky(op, opcode):
+  """Conditional branch with RAM on the bus (see _assemble)"""
+  return op & _maskOp == _opJ and opcode & _maskBus == _busRAM and\
+    op & _maskCc in [ _jGT, _jLT, _jNE, _jEQ, _jGE, _jLE ]
+
+def _shape(x):
+  """Key for one element of the list notation: a register or a type"""
+  return x if x.__class__ is _str else x.__class__
+
+# Precomputed encodings, keyed by (operation, operand shape, target register,
+# address shape). Every entry is derived from _encode() itself, by probing it
+# with marker values to find out where the D operand comes from. Any shape not
+# in the table (floats, bytes, odd list notations, invalid combinations) takes
+# the slow path in _assemble(), which also reports the errors.
+_fromVal, _fromLabel, _fromAddr = 'val', 'label', 'addr'
+_encodings = {}
+def _makeEncodings():
+  ops = [_opLD, _opAND, _opOR, _opXOR, _opADD, _opSUB, _opST, _opST|_busRAM]
+  ops += [_opJ|cc for cc in [_jL, _jGT, _jLT, _jNE, _jEQ, _jGE, _jLE, _jS]]
+  vals = [None, AC, IN, 0x11]
+  addrs = [None, [0x22], [X], [Y,0x22], [Y,X], [Y,Xpp]]
+  for op in ops:
+    for val in vals:
+      for to in [AC, X, Y, OUT, None]:
+        for addr in addrs:
+          try:
+            opcode, d = _encode(op, val, to, addr)
+          except AssertionError:
+            continue # Invalid combination, left to the slow path
+          source = {0x11: _fromVal, 0x22: _fromAddr, 0: None}[d]
+          aShape = None if addr is None else tuple(map(_shape, addr))
+          vShape = val if val in [None, AC, IN] else int
+          encoding = opcode, source, _isRisky(op, opcode)
+          _encodings[op, vShape, to, aShape] = encoding
+          if vShape is int:
+            # Label operands encode like numbers, with D resolved by lo()
+            encoding = opcode, _fromLabel, _isRisky(op, opcode)
+            _encodings[op, _str, to, aShape] = encoding
+_makeEncodings()
 
-  # Warning for conditional branches with a target address from RAM. The (unverified) danger is
-  # that the ALU is calculating `-A' (for the condition decoder) as L+R+1, with L=0 and R=~A. But B
-  # is also an input to R and comes from memory. The addressing mode is [D], which requires high
-  # EH and EL, and this is slower when the diodes are forward biased from the previous instruction.
-  # Therefore R might momentarily glitch while B changes value and the AND/OR layers in the 74153
-  # multiplexer resettles. Such a glitch then potentially ripples all the way through two 74283
-  # adders and the control unit's 74153. This all depends on the previous instruction's addressing
-  # mode and the values of AC and [D], which we can't know with static analysis.
-  # See also https://github.com/kervinck/gigatron-rom/issues/78
-  if warn and op & _maskOp == _opJ and bus == _busRAM and\
-    op & _maskCc in [ _jGT, _jLT, _jNE, _jEQ, _jGE, _jLE ]:
-    highlight('Warning: %04x : large propagation delay (conditional branch with RAM on bus)' % _romSize)
-
-  
 _mnemonics = [ 'ld', 'anda', 'ora', 'xora', 'adda', 'suba', 'st', 'j' ]
 
-def _hexString(val):
-  return '$%02x' % val
-
-def disassemble(opcode, operand, address=None, lastOpcode=None):
+def _template(opcode):
+  """Disassembly of one opcode, with '{0:02x}' standing for the operand"""
   text = _mnemonics[opcode >> 5] # (74LS155)
   isStore = (opcode & _maskOp) == _opST
+  operand = '${0:02x}'
 
   # Decode addressing and register mode (74LS138)
   if text != 'j':
-    if opcode & _maskMode == _ea0DregAC:    _ea, reg = '[%s]' % _hexString(operand), 'ac'
+    if opcode & _maskMode == _ea0DregAC:    _ea, reg = '[%s]' % operand, 'ac'
     if opcode & _maskMode == _ea0XregAC:    _ea, reg = '[x]', 'ac'
-    if opcode & _maskMode == _eaYDregAC:    _ea, reg = '[y,%s]' % _hexString(operand), 'ac'
+    if opcode & _maskMode == _eaYDregAC:    _ea, reg = '[y,%s]' % operand, 'ac'
     if opcode & _maskMode == _eaYXregAC:    _ea, reg = '[y,x]', 'ac'
-    if opcode & _maskMode == _ea0DregX:     _ea, reg = '[%s]' % _hexString(operand), 'x'
-    if opcode & _maskMode == _ea0DregY:     _ea, reg = '[%s]' % _hexString(operand), 'y'
-    if opcode & _maskMode == _ea0DregOUT:   _ea, reg = '[%s]' % _hexString(operand), 'out'
+    if opcode & _maskMode == _ea0DregX:     _ea, reg = '[%s]' % operand, 'x'
+    if opcode & _maskMode == _ea0DregY:     _ea, reg = '[%s]' % operand, 'y'
+    if opcode & _maskMode == _ea0DregOUT:   _ea, reg = '[%s]' % operand, 'out'
     if opcode & _maskMode == _eaYXregOUTIX: _ea, reg = '[y,x++]', 'out'
   else:
-    _ea = '[%s]' % _hexString(operand)
+    _ea = '[%s]' % operand
 
   # Decode bus mode (74LS139)
-  if opcode & _maskBus == _busD:   bus = _hexString(operand)
+  if opcode & _maskBus == _busD:   bus = operand
   if opcode & _maskBus == _busRAM: bus = None if isStore else _ea
   if opcode & _maskBus == _busAC:  bus = 'ac'
   if opcode & _maskBus == _busIN:  bus = 'in'
 
   if text == 'j':
-    # Decode jumping mode (74LS153)
-    if opcode & _maskCc == _jL:  text = 'jmp  y,'
-    if opcode & _maskCc == _jS:  text = 'bra  '
-    if opcode & _maskCc == _jEQ: text = 'beq  '
-    if opcode & _maskCc == _jNE: text = 'bne  '
-    if opcode & _maskCc == _jGT: text = 'bgt  '
-    if opcode & _maskCc == _jGE: text = 'bge  '
-    if opcode & _maskCc == _jLT: text = 'blt  '
-    if opcode & _maskCc == _jLE: text = 'ble  '
-    if address is not None and opcode & _maskCc != _jL and opcode & _maskBus == _busD:
-      # We can calculate the destination address
-      lo, hi = address & 255, address >> 8
-      if lo == 255: # When branching from $xxFF, we still end up in the next page
-        hi = (hi + 1) & 255
-      destination = (hi << 8) + operand
-      if lastOpcode & (_maskOp|_maskCc) == _opJ|_jL:
-        bus = '$%02x' % operand
-      elif destination in _labels:
-        bus = _labels[destination][-1]
-      else:
-        bus = '$%04x' % destination
-    text += bus
+    text = _branchText(opcode) + bus
   else:
     # Compose string
     if isStore:
@@ -447,10 +569,64 @@ def disassemble(opcode, operand, address=None, lastOpcode=None):
         text = '%-4s %s,%s' % (text, bus, reg)
       # Specials
       if opcode == _opLD | _busAC: text = 'nop'
-
-  # Emit as text
   return text
 
+def _branchText(opcode):
+  # Decode jumping mode (74LS153)
+  return {
+    _jL:  'jmp  y,', _jS:  'bra  ',
+    _jEQ: 'beq  ',   _jNE: 'bne  ',
+    _jGT: 'bgt  ',   _jGE: 'bge  ',
+    _jLT: 'blt  ',   _jLE: 'ble  ',
+  }[opcode & _maskCc]
+
+# Mnemonic templates for all 256 opcodes
+_templates = [_template(opcode) for opcode in range(256)]
+
+# Branches within the page, whose destination can be shown when the address is known
+_isLocalBranch = [opcode & _maskOp == _opJ and opcode & _maskCc != _jL and
+                  opcode & _maskBus == _busD for opcode in range(256)]
+
+# Disassembly of all 64K instruction words (opcode<<8 | operand), made on first use
+_disassembly = []
+
+def _getDisassembly():
+  if not _disassembly:
+    _disassembly.extend(t.format(operand) for t in _templates for operand in range(256))
+  return _disassembly
+
+def _branchDestination(opcode, operand, address, lastOpcode, labels):
+  # We can calculate the destination address
+  lo, hi = address & 255, address >> 8
+  if lo == 255: # When branching from $xxFF, we still end up in the next page
+    hi = (hi + 1) & 255
+  destination = (hi << 8) + operand
+  if lastOpcode is not None and lastOpcode & (_maskOp|_maskCc) == _opJ|_jL:
+    bus = '$%02x' % operand
+  elif destination in labels:
+    bus = labels[destination][-1]
+  else:
+    bus = '$%04x' % destination
+  return _branchText(opcode) + bus
+
+def disassemble(opcode, operand, address=None, lastOpcode=None):
+  if address is not None and _isLocalBranch[opcode]:
+    return _branchDestination(opcode, operand, address, lastOpcode, _labels)
+  return _getDisassembly()[opcode << 8 | operand]
+
+def disassembleRom(rom0, rom1, labels=None):
+  """Disassemble a sequence of ROM words starting at address 0, in one pass"""
+  labels = _labels if labels is None else labels
+  table = _getDisassembly()
+  listing = [table[opcode << 8 | operand] for opcode, operand in zip(rom0, rom1)]
+  # Fix up the branches within a page, they depend on address and label
+  lastOpcode = None
+  for address, opcode in enumerate(rom0):
+    if _isLocalBranch[opcode]:
+      listing[address] = _branchDestination(opcode, rom1[address], address, lastOpcode, labels)
+    lastOpcode = opcode
+  return listing
+
 # Read a given file Python source file, using the correct encoding.
 # Taken from the Python3 reference Section 2.1.4
 _encodingRe = re.compile(rb'coding[=:]\s*([-\w.]+)')
@@ -469,6 +645,8 @@ def _readSource(filename):
 # Start to include source lines in output listing
 def enableListing():
   global _listing, _listingSource, _lineno
+  if has(_listing):
+    _resolveLinenos()
   _listing = inspect.currentframe().f_back
   info = inspect.getframeinfo(_listing)
   _listingSource = _readSource(info.filename)
@@ -485,39 +663,292 @@ def _getSourceLines(upto):
     _lineno = max(_lineno, upto+1)
   return lines
 
-# Stop listing source lines (introspection is slow)
+# _emit() only records the bytecode offset of the listing frame, because
+# reading f_lineno is slow (see asmbase.sourceLine). Translate them here.
+def _resolveLinenos():
+  code, cache = _listing.f_code, {}
+  for address, offset in _offsets.items():
+    _linenos[address] = asmbase.sourceLine(code, offset, cache)
+  _offsets.clear()
+
+# Stop listing source lines
 def disableListing():
   global _listing, _lineno
-  for lineno in range(_linenos[-1], _listing.f_lineno+1):
+  _resolveLinenos()
+  for lineno in range(_linenos[_romSize-1], _listing.f_lineno+1):
     source = '%-4d  %s' % (lineno, _listingSource[lineno-1])
     C(source.rstrip(), prefix='') # A bit tricky: stuff in *comments*
-  _linenos[-1] = None # Avoid double listing of this line
+  del _linenos[_romSize-1] # Avoid double listing of this line
   _listing = None
 
 def _emit(opcode, operand):
   global _romSize, _maxRomSize
-  lineno = _listing.f_lineno if has(_listing) else None
   if _romSize >= _maxRomSize:
       disassembly = disassemble(opcode, operand)
       print('%04x %02x%02x  %s' % (_romSize, opcode, operand, disassembly))
       highlight('Error: Program size limit exceeded')
       _maxRomSize = 0x10000 # Extend to full address space to prevent more of the same errors
-  _rom0.append(opcode)
-  _rom1.append(operand)
-  _linenos.append(lineno)
+  if _listing is not None:
+    _offsets[_romSize] = _listing.f_lasti
+  _rom0[_romSize] = opcode  # IndexError past 64K words, when the error was caught
+  _rom1[_romSize] = operand
   _romSize += 1
 
+# Parsed bindings files, shared by all assemblers in the process
+# File name -> (modification time, symbols)
+_bindings = {}
+
 def loadBindings(symfile):
   # Load JSON file into symbol table
   global _symbols
-  with open(symfile) as file:
-    for (name, value) in json.load(file).items():
-      if not isinstance(value, int):
-        value = int(value, base=0)
-      _symbols[_str(name)] = value
+  symfile = str(symfile)
+  mtime = os.stat(symfile).st_mtime_ns
+  if symfile not in _bindings or _bindings[symfile][0] != mtime:
+    symbols = {}
+    with open(symfile) as file:
+      for (name, value) in json.load(file).items():
+        if not isinstance(value, int):
+          value = int(value, base=0)
+        symbols[_str(name)] = value
+    _bindings[symfile] = mtime, symbols
+  _symbols.update(_bindings[symfile][1])
 
 def getRom1():
-  return bytearray(_rom1)
+  return _rom[1:2*_romSize:2]
+
+# Static timing analysis
+#
+# Native code must keep exact time. Each scan line takes 200 cycles, and a
+# SYS function may not run longer than the cycle count in its name, such as
+# SYS_Random_34. _checkTiming() verifies this without running the code, by
+# following all paths through the ROM image, one cycle per instruction.
+# For the video loop, the source declares with cycle() where an instruction
+# must be in the scan line, and all paths from one such declaration to the
+# next must take exactly the difference.
+#
+# Branch destinations are followed when they are known: within the page, or
+# for jmp(Y,...) when Y was loaded with a known value on the same path. For
+# this AC and Y are tracked as far as they hold constants, which also takes
+# conditional branches in counting loops, such as those made by wait(), in
+# the right direction. Jumps to destinations that come from RAM or AC, for
+# example into the vCPU, end the path. Except when the delay slot holds a
+# branch: then one unknown instruction runs before the path continues at
+# that branch's destination (a lookup table with single-instruction entries).
+# Where such a jump ends a path from a cycle() declaration, for example
+# bra([nextVideo]), the source declares with landing() at which cycle its
+# destination must execute, and all paths must arrive exactly then.
+#
+# Some SYS functions check the remaining time themselves, for example to run
+# longer than their name says, or to take another pass. A conditional branch
+# on [vTicks] plus a constant is such a check, and ends the path as well.
+# Without a vTicks symbol such checks can't be recognized, and the durations
+# of SYS functions aren't checked at all.
+
+_sysRe = re.compile(r'SYS_\w+_(\d+)$')
+_sysCycle = 15  # SYS functions start at this cycle
+_scanLine = 200 # Declared cycles count within the scan line
+_ticks = 'ticks' # Value of AC when it holds [vTicks] plus a constant
+
+def _alu(op, a, b):
+  """ALU result for known inputs, or None"""
+  if op == _opLD:
+    return b
+  if _ticks in [a, b] and op in [_opADD, _opSUB] and None not in [a, b]:
+    return _ticks
+  if a is None or b is None or _ticks in [a, b]:
+    return None
+  if op == _opAND: return a & b
+  if op == _opOR:  return a | b
+  if op == _opXOR: return a ^ b
+  if op == _opADD: return (a + b) & 255
+  if op == _opSUB: return (a - b) & 255
+
+def _isTaken(cc, ac):
+  """Outcome of a conditional branch, or None if AC is unknown"""
+  if ac is None:
+    return None
+  return {
+    _jGT: 0 < ac < 128, _jLT: ac >= 128,
+    _jNE: ac != 0,      _jEQ: ac == 0,
+    _jGE: ac < 128,     _jLE: ac == 0 or ac >= 128,
+  }[cc]
+
+def _nextStates(state, vTicks):
+  """Possible states after executing one instruction, or None for a time check
+
+  A state is (pc, next pc, AC, Y), with None for unknown values"""
+  pc, npc, ac, y = state
+  if pc is None:
+    # Unknown instruction in the delay slot of a branch
+    return [] if npc is None else [(npc, npc+1, None, None)]
+  if pc >= _romSize:
+    return []
+  opcode, operand = _rom0[pc], _rom1[pc]
+  op, mode, bus = opcode & _maskOp, opcode & _maskMode, opcode & _maskBus
+
+  if op != _opJ:
+    if npc is None:
+      return [] # Unknown jump destination
+    if bus == _busD:    b = operand
+    elif bus == _busAC: b = ac
+    elif bus == _busRAM and _isZeroPage[opcode] and operand == vTicks: b = _ticks
+    else:               b = None
+    if op == _opST:
+      if mode == _ea0DregY:
+        y = None
+    elif mode == _ea0DregY:
+      y = _alu(op, ac, b)
+      y = None if y is _ticks else y
+    elif mode < _ea0DregX:
+      ac = _alu(op, ac, b)
+    return [(npc, npc+1, ac, y)]
+
+  cc = mode
+  if bus != _busD:
+    target = None
+  elif cc == _jL:
+    target = None if y is None else y << 8 | operand
+  elif npc is not None:
+    target = npc & 0xff00 | operand
+  elif _rom0[pc-1] & (_maskOp|_maskCc) != _opJ|_jL:
+    target = pc & 0xff00 | operand # In the delay slot of a branch within the page
+  else:
+    target = None if y is None else y << 8 | operand # In the delay slot of jmp(Y,...)
+  if cc in [_jL, _jS]:
+    taken = True
+  elif ac is _ticks:
+    return None
+  else:
+    taken = _isTaken(cc, ac)
+  states = []
+  if taken is not False:
+    states.append((npc, target, ac, y))
+  if taken is not True and npc is not None:
+    states.append((npc, npc+1, ac, y))
+  return states
+
+def _timePaths(start, cycle, y, stops, vTicks=None):
+  """Follow all paths from start until they reach an address in stops
+
+  Return the earliest and latest arrival cycle for each stop reached, the
+  same for the destination of each jump to an unknown address, and for
+  paths that loop back into themselves or check the time (or None if there
+  are no such paths)"""
+  # Depth-first search, for the order of states and to find the loops.
+  # Revisiting an address with a known AC is progress in a counting loop,
+  # with an unknown AC it means the path is looping.
+  def loopKey(state):
+    return state[:2] if state[2] is None else state
+  def isEnd(state):
+    # A stop in the delay slot of a taken branch doesn't end the path
+    return state[0] in stops and state[1] == state[0] + 1
+  def isLanding(state):
+    # The delay slot of a jump to an unknown address
+    pc, npc = state[:2]
+    return has(pc) and npc is None and pc < _romSize and _rom0[pc] & _maskOp != _opJ
+  def todo(state):
+    nextStates = _nextStates(state, vTicks)
+    if nextStates is None:
+      ends.append(state)
+      nextStates = []
+    return iter(nextStates)
+  first = start, start+1, None, y
+  edges, ends, order = {first: []}, [], []
+  onPath = {loopKey(first)}
+  stack = [(first, todo(first))]
+  while stack:
+    state, nextStates = stack[-1]
+    for next in nextStates:
+      if loopKey(next) in onPath:
+        ends.append(state)
+        continue
+      edges[state].append(next)
+      if next not in edges and not isEnd(next):
+        edges[next] = []
+        onPath.add(loopKey(next))
+        stack.append((next, todo(next)))
+        break
+    else:
+      stack.pop()
+      onPath.remove(loopKey(state))
+      order.append(state)
+
+  # Count cycles along all paths, in topological order
+  ranges, arrivals, landings = {first: (cycle, cycle)}, {}, {}
+  def merge(d, k, lo, hi):
+    lo0, hi0 = d.get(k, (lo, hi))
+    d[k] = min(lo0, lo), max(hi0, hi)
+  for state in reversed(order):
+    lo, hi = ranges[state]
+    if isLanding(state):
+      merge(landings, state[0]-1, lo+1, hi+1) # Keyed by the jump
+    for next in edges[state]:
+      if next[0] in stops:
+        merge(arrivals, next[0], lo+1, hi+1)
+      if next in edges:
+        merge(ranges, next, lo+1, hi+1)
+  ending = None
+  if ends:
+    ending = (min(ranges[state][0] for state in ends) + 1,
+              max(ranges[state][1] for state in ends) + 1)
+  return arrivals, landings, ending
+
+# Instructions that access a zero page variable [D], excluding jumps
+_isZeroPage = [opcode & _maskOp != _opJ and
+               opcode & _maskMode in [_ea0DregAC, _ea0DregX, _ea0DregY, _ea0DregOUT] and
+               (opcode & _maskBus == _busRAM or opcode & _maskOp == _opST)
+               for opcode in range(256)]
+
+def _where(address):
+  return _labels[address][-1] if address in _labels else '$%04x' % address
+
+def _checkTiming():
+  """Check SYS function durations, and paths between declared cycles"""
+
+  # SYS functions are entered with Y=hi(sysFn), and end when reaching NEXT
+  # or their own time check (only recognized when the source defines vTicks)
+  sysCount, unknown = 0, 0
+  if 'NEXT' in _symbols and 'vTicks' in _symbols:
+    stops = {_symbols['NEXT']}
+    vTicks = _symbols['vTicks']
+    for address, names in sorted(_labels.items()):
+      budgets = [(name, int(m.group(1))) for name in names for m in [_sysRe.match(name)] if m]
+      if not budgets:
+        continue
+      arrivals, _, ending = _timePaths(address, _sysCycle, address >> 8, stops, vTicks)
+      worst = max([hi for lo, hi in arrivals.values()] + [ending[1] if ending else 0])
+      for name, budget in budgets:
+        if worst > budget:
+          highlight('Warning: %s takes up to %d cycles' % (name, worst))
+      sysCount += 1
+      if not arrivals and not ending:
+        unknown += 1 # All paths lead to unknown jump destinations
+
+  # Paths from one declared cycle to the next must arrive exactly on time,
+  # and so must the destinations of the jumps they end with
+  stops = set(_cycles)
+  for address, cycle in sorted(_cycles.items()):
+    arrivals, landings, ending = _timePaths(address, cycle, None, stops)
+    for other, (lo, hi) in sorted(arrivals.items()):
+      if lo != hi or lo % _scanLine != _cycles[other]:
+        when = '%d' % lo if lo == hi else '%d-%d' % (lo, hi)
+        highlight('Warning: path from %s (cycle %d) arrives at %s at cycle %s instead of %d' %
+                  (_where(address), cycle, _where(other), when, _cycles[other]))
+    for jump, (lo, hi) in sorted(landings.items()):
+      if jump not in _landings:
+        highlight('Warning: path from %s (cycle %d) reaches jump at %s without landing()' %
+                  (_where(address), cycle, _where(jump)))
+      elif lo != hi or lo % _scanLine != _landings[jump]:
+        when = '%d' % lo if lo == hi else '%d-%d' % (lo, hi)
+        highlight('Warning: path from %s (cycle %d) lands from %s at cycle %s instead of %d' %
+                  (_where(address), cycle, _where(jump), when, _landings[jump]))
+    if ending:
+      highlight('Warning: path from %s (cycle %d) loops' % (_where(address), cycle))
+    if not arrivals and not landings and not ending:
+      highlight('Warning: path from %s (cycle %d) reaches no declared cycle' % (_where(address), cycle))
+
+  print('Timing checked for %d SYS functions (%d without known end), %d cycle declarations and %d landings' %
+        (sysCount, unknown, len(_cycles), len(_landings)))
 
 # Write ROM files and listing
 def writeRomFiles(sourceFile):
@@ -531,6 +962,9 @@ def writeRomFiles(sourceFile):
   stem = basename(stem)
   if stem == '': stem = 'out'
 
+  # Verify timing before anything else
+  _checkTiming()
+
   # Clarification header emitted once before first instruction
   header = ('              address\n'
             '              |    encoding\n'
@@ -543,7 +977,6 @@ def writeRomFiles(sourceFile):
   filename = stem + '.lst'
   print('Create file', filename)
   with open(filename, 'w', encoding='utf-8') as file:
-    address = 0
     repeats, previous, line0 = 0, None, None
     maxRepeat = 3
 
@@ -552,9 +985,14 @@ def writeRomFiles(sourceFile):
     file.write('* source: %s\n' % relpath(info.filename))
 
     # Disassemble and list all ROM words
-    lastOpcode = None
-    for instruction in zip(_rom0, _rom1, _linenos):
-      opcode, operand, lineno = instruction
+    if has(_listing):
+      _resolveLinenos()
+    rom0, rom1 = _rom[0:2*_romSize:2], _rom[1:2*_romSize:2]
+    disassembly = disassembleRom(rom0, rom1)
+    for address in range(_romSize):
+      opcode, operand = rom0[address], rom1[address]
+      lineno = _linenos.get(address)
+      instruction = opcode, operand, lineno
 
       # All labels as list, if any
       labels = _labels[address] if address in _labels else None
@@ -592,7 +1030,7 @@ def writeRomFiles(sourceFile):
       # Preformat
       line1 = labels[-1] + ':' if has(labels) else ''
       line2 = '%04x %02x%02x' % (address, opcode, operand)
-      line2 += '  ' + disassemble(opcode, operand, address, lastOpcode)
+      line2 += '  ' + disassembly[address]
       if has(comment):
         line2 = '%-27s %s' % (line2, comment)
 
@@ -628,17 +1066,11 @@ def writeRomFiles(sourceFile):
         # Abbreviate with a simple count when too many repetitions
         line0 = '%13s * %d times' % ('', 1+repeats)
 
-      # Next ROM byte
-      address += 1
-      lastOpcode = opcode
-
     # Wrap up. Flush any pending line
     if line0:
       file.write(line0 + '\n')
     # List end address or size
-    file.write(14*' '+'%04x\n' % address)
-    assert len(_rom0) == _romSize
-    assert len(_rom1) == _romSize
+    file.write(14*' '+'%04x\n' % _romSize)
 
 # # Write ROM files for breadboard with two EEPROMs
 # filename = stem + '.lo.rom'
@@ -654,18 +1086,15 @@ def writeRomFiles(sourceFile):
   # 16-bit version for 27C1024, little endian
   filename = stem + '.rom'
   print('Create file', filename)
-  _rom2 = bytearray()
-  for x, y in zip(_rom0, _rom1):
-    _rom2.append(x)
-    _rom2.append(y)
-  # Padding
-  while len(_rom2) < 2*_maxRomSize:
-    _rom2.append(b'Gigatron!'[ (len(_rom2)-2*_maxRomSize) % 9 ])
+  # Padding, in place after the last word
+  used, size = 2*_romSize, max(2*_romSize, 2*_maxRomSize)
+  phase = (used - 2*_maxRomSize) % 9
+  _rom[used:size] = (b'Gigatron!' * (size//9 + 2))[phase:phase+size-used]
   # Write ROM file
   with open(filename, 'wb') as file:
-    file.write(_rom2)
+    file.write(memoryview(_rom)[:size])
 
-  print('ROM bytes %d words %d' % (len(_rom2), len(_rom2)//2))
+  print('ROM bytes %d words %d' % (size, size//2))
   print('Words used %d unused %d' % (_romSize, _maxRomSize-_romSize))
   print('Assembly OK')
 
@@ -689,19 +1118,25 @@ def highlight(*args):
 #   are removed from sys.argv and collected into a dict.
 # - function defined('SYMBOL') returns VALUE or 1 if the
 #   symbol was defined, None if if wasn't.
-_defined = {}
 def defined(s, default=None):
   if s in _defined:
     return _defined[s]
   return default
-import ast
-for i in reversed(range(len(sys.argv))):
-  arg = sys.argv[i]
-  if arg.startswith("-D"):
-    arg, val = arg[2:], 1
-    if '=' in arg:
-      arg, val = arg.split('=', 1)
-      val = ast.literal_eval(val)
-    _defined[arg]=val
-    del sys.argv[i]
+
+def parseDefines(argv):
+  """Remove -DSYMBOL[=VALUE] arguments from argv and return them as dict"""
+  defines = {}
+  for i in reversed(range(len(argv))):
+    arg = argv[i]
+    if arg.startswith("-D"):
+      arg, val = arg[2:], 1
+      if '=' in arg:
+        arg, val = arg.split('=', 1)
+        val = ast.literal_eval(val)
+      defines[arg]=val
+      del argv[i]
+  return defines
+
+_current = None
+Assembler(parseDefines(sys.argv)).activate()
 
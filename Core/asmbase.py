@@ -0,0 +1,65 @@
+# Machinery shared by asm.py and vasm.py
+#
+# Both assemblers keep the state of the current assembly in module
+# variables, so that the functions that make up their source language
+# can stay plain functions. Their Assembler classes derive from State,
+# which swaps such state in and out of the module.
+#
+# Both can also tell for every emitted instruction from which source line
+# it came. For this they only record the code object and bytecode offset
+# (f_lasti) of the frame, and sourceLine() turns these into line numbers
+# when they are needed.
+
+from bisect import bisect_right
+import dis
+
+class State:
+  """Assembler state, kept in module variables while current
+
+  A subclass sets _globals to the globals() of its module and _names to
+  the names of the variables that hold the state, and passes their
+  initial values to __init__(). The module variable _current refers to
+  the current assembler. Another one becomes current while used as
+  context manager, and the one before it comes back afterwards.
+  """
+  _globals = None
+  _names = []
+
+  def __init__(self, state):
+    self._state = state
+    self._outer = []
+
+  def __enter__(self):
+    self._outer.append(self._globals['_current'])
+    self.activate()
+    return self
+
+  def __exit__(self, *exc):
+    self._outer.pop().activate()
+
+  def activate(self):
+    """Make this assembler current by swapping its state in"""
+    g = self._globals
+    current = g['_current']
+    if self is not current:
+      if current:
+        current._state = {name: g[name] for name in self._names}
+      g.update(self._state)
+      g['_current'] = self
+
+def sourceLine(code, offset, cache):
+  """Line number of the bytecode at offset in code
+
+  Reading f_lineno of a frame is slow for long code objects: Python finds
+  it by walking the line table from its start. Here each line table is
+  read once, into cache, together with the lines already looked up."""
+  if (code, offset) not in cache:
+    if code not in cache:
+      starts, lines = [], []
+      for start, lineno in dis.findlinestarts(code):
+        starts.append(start)
+        lines.append(lineno)
+      cache[code] = starts, lines
+    starts, lines = cache[code]
+    cache[code, offset] = lines[bisect_right(starts, offset) - 1]
+  return cache[code, offset]
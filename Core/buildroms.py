@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+#-----------------------------------------------------------------------
+#
+#  buildroms.py -- Assemble several ROM images from one driver
+#
+#  Each argument is a complete ROM build command, as it would be given
+#  to the shell, for example:
+#
+#    Core/buildroms.py 'Core/dev.asm.py -DROMNAME=\"dev7.rom\" Main=...'\
+#                      'Core/dev.asm.py -DROMNAME=\"dev128k7.rom\" ...'
+#
+#  The builds run in a pool of worker processes. Every build gets its
+#  own asm.Assembler, so workers can be reused for the next build.
+#  The output of each build is printed as a whole, in argument order.
+#
+#-----------------------------------------------------------------------
+
+import argparse
+import contextlib
+import io
+import os
+import runpy
+import shlex
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import asm
+
+#-----------------------------------------------------------------------
+#       Command line arguments
+#-----------------------------------------------------------------------
+
+parser = argparse.ArgumentParser(description='Assemble several ROM images')
+parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=os.cpu_count(),
+                    help='Number of worker processes (default: number of CPUs)')
+parser.add_argument('commands', nargs='+', metavar='command',
+                    help='ROM build command, e.g. "Core/dev.asm.py -DROMNAME=\\"dev7.rom\\" ..."')
+
+#-----------------------------------------------------------------------
+#       Build
+#-----------------------------------------------------------------------
+
+def build(command):
+  """Run one ROM build script, return its success and output"""
+  argv = shlex.split(command)
+  defines = asm.parseDefines(argv)
+  modules = set(sys.modules)
+  output = io.StringIO()
+  ok = True
+  with asm.Assembler(defines), contextlib.redirect_stdout(output):
+    sys.argv = argv
+    try:
+      runpy.run_path(argv[0], run_name='__main__')
+    except SystemExit as e:
+      ok = e.code in [None, 0]
+    except Exception:
+      traceback.print_exc(file=output)
+      ok = False
+    finally:
+      # Modules such as SYS extensions must run again in the next build
+      for name in set(sys.modules) - modules:
+        del sys.modules[name]
+  return ok, output.getvalue()
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  failed = 0
+  with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+    for command, (ok, output) in zip(args.commands, pool.map(build, args.commands)):
+      print('***', command)
+      print(output, end='')
+      if not ok:
+        failed += 1
+  if failed:
+    print('%d of %d builds failed' % (failed, len(args.commands)))
+    sys.exit(1)
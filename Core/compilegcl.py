@@ -8,16 +8,26 @@
 # 2018-06-24 (at67)    Optional output directory
 # 2019-07-07 (marcelk) Remove stack trace suppression
 #
+#  Several GCL files can be given at once, for example:
+#
+#    Core/compilegcl.py -j 8 --same-dir Apps/*/*.gcl
+#
+#  They are compiled in a pool of worker processes, each file with its
+#  own asm.Assembler. The output of each file is printed as a whole,
+#  in argument order, followed by a summary of sizes and timings.
+#
 #-----------------------------------------------------------------------
 
-from __future__ import print_function
 import argparse
+import contextlib
+import io
+import os
 import sys
-from sys import argv
-from os  import getenv
-from os.path import basename, splitext
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from os.path import basename, dirname, splitext
 
-import asm
 import gcl0x as gcl
 
 #-----------------------------------------------------------------------
@@ -29,77 +39,110 @@ parser.add_argument('-s', '--sym', dest='sym', default='interface.json',
                     help='Symbol file for interface bindings (default interface.json)')
 parser.add_argument('-x', dest='gt1x', default=False, action='store_true',
                     help='Create .gt1x file'),
-parser.add_argument('gclSource',
-                    help='GCL file')
+parser.add_argument('-m', '--merge', dest='merge', default=False, action='store_true',
+                    help='Merge adjacent GT1 segments, for faster loading')
+parser.add_argument('--cycles', dest='cycles', default=False, action='store_true',
+                    help='Report static vCPU cycle counts per def and loop body')
+parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=os.cpu_count(),
+                    help='Number of worker processes for several files (default: number of CPUs)')
+parser.add_argument('--same-dir', dest='sameDir', default=False, action='store_true',
+                    help='Write each GT1 file in the directory of its GCL file')
+parser.add_argument('gclSource', nargs='+',
+                    help='GCL file, or several')
 parser.add_argument('outputDir', nargs='?', default='.',
                     help='Optional output directory')
-args = parser.parse_args()
 
 #-----------------------------------------------------------------------
 #       Compile
 #-----------------------------------------------------------------------
 
-asm.loadBindings(args.sym)
-if args.gt1x:
-  asm.loadBindings('Core/interface-dev.json')
-
-userCode = asm.symbol('userCode')
-userVars = asm.symbol('userVars')
-
-print('Compiling file %s' % args.gclSource)
-program = gcl.Program('Main', forRom=False)
-program.org(userCode)
-asm.align(1)          # Forces default maximum ROM size
-asm.zpReset(userVars) # User variables can start here
-for line in open(args.gclSource).readlines():
-  program.line(line)
-program.end()
-asm.end() # End assembly
-data = asm.getRom1()
-
-#-----------------------------------------------------------------------
-#       Append ending
-#-----------------------------------------------------------------------
-
-address = program.execute
-
-# Inject patch for reliable start using ROM v1 Loader application
-# See: https://forum.gigatron.io/viewtopic.php?p=27#p27
-if program.needPatch:
-  patchArea = 0x5b86 # Somewhere after the ROMv1 Loader's buffer
-  print('Apply patch $%04x' % patchArea)
-  data = data[:-1] # Remove terminating zero
-  data += bytes([
-    patchArea>>8, patchArea&255, 6,   # Patch segment, 6 bytes at $5b80
-    0x11, address&255, address>>8,    # LDWI address
-    0x2b, 0x1a,                       # STW  vLR
-    0xff,                             # RET
-
-    0x00
-  ])
-  address = patchArea
-
-# Final two bytes are execution address
-print('Execute at $%04x' % address)
-data.append(address>>8)
-data.append(address&255)
+def compileGcl(gclSource, outputDir, sym, gt1x, merge=False, cycles=False):
+  """Compile one GCL file into a GT1 file, return the size of the file"""
+  bindings = [sym, 'Core/interface-dev.json'] if gt1x else [sym]
+
+  print('Compiling file %s' % gclSource)
+  with open(gclSource) as file:
+    image = gcl.compileGcl(file.read(), bindings=bindings, reportCycles=cycles)
+  print('Execute at $%04x' % image.execute)
+
+  if merge:
+    merged = image.merged()
+    frames = image.loaderFrames(), merged.loaderFrames()
+    print('Merged %d segments into %d, Loader frames %d -> %d (%.2fs faster)' % (
+      len(image.segments), len(merged.segments),
+      frames[0], frames[1], (frames[0] - frames[1]) / 60))
+    image = merged
+  data = bytes(image)
+
+  #---------------------------------------------------------------------
+  #     Write out GT1 file
+  #---------------------------------------------------------------------
+
+  stem = basename(splitext(gclSource)[0])
+  gt1File = outputDir + '/' + stem + '.gt1' # Resulting object file
+  if gt1x:
+    gt1File += 'x'
+
+  print('Create file', gt1File)
+
+  with open(gt1File, 'wb') as output:
+    output.write(data)
+
+  print('OK size', len(data))
+  print()
+  return len(data)
+
+def build(job):
+  """Compile one file, return size (None on failure), time and output"""
+  gclSource, outputDir, sym, gt1x, merge, cycles = job
+  output = io.StringIO()
+  size = None
+  start = time.perf_counter()
+  with contextlib.redirect_stdout(output):
+    try:
+      size = compileGcl(gclSource, outputDir, sym, gt1x, merge, cycles)
+    except SystemExit:
+      pass
+    except Exception:
+      traceback.print_exc(file=output)
+  return size, time.perf_counter() - start, output.getvalue()
 
 #-----------------------------------------------------------------------
-#       Write out GT1 file
+#       Main
 #-----------------------------------------------------------------------
 
-stem = basename(splitext(args.gclSource)[0])
-gt1File = args.outputDir + '/' + stem + '.gt1' # Resulting object file
-if args.gt1x:
-  gt1File += 'x'
-
-print('Create file', gt1File)
-
-with open(gt1File, 'wb') as output:
-  output.write(data)
-
-print('OK size', len(data))
-print()
+if __name__ == '__main__':
+  args = parser.parse_args()
+
+  # With several files, a trailing non-GCL argument is the output directory
+  sources = args.gclSource
+  if len(sources) > 1 and not sources[-1].endswith('.gcl'):
+    sources, args.outputDir = sources[:-1], sources[-1]
+
+  if len(sources) == 1 and not args.sameDir:
+    # Single file: compile in this process, with output as it comes
+    compileGcl(sources[0], args.outputDir, args.sym, args.gt1x, args.merge, args.cycles)
+    sys.exit(0)
+
+  jobs = [(gclSource, (dirname(gclSource) or '.') if args.sameDir else args.outputDir,
+           args.sym, args.gt1x, args.merge, args.cycles) for gclSource in sources]
+  with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+    results = list(pool.map(build, jobs))
+
+  failed, total = 0, 0.0
+  for gclSource, (size, seconds, output) in zip(sources, results):
+    print(output, end='')
+    if size is None:
+      failed += 1
+    total += seconds
+
+  print('Summary')
+  print(' %-48s %6s %8s' % ('File', 'Size', 'Time'))
+  for gclSource, (size, seconds, output) in zip(sources, results):
+    print(' %-48s %6s %7.3fs' % (gclSource, size if size is not None else 'failed', seconds))
+  print(' %d files, %d failed, %.3fs compile time' % (len(sources), failed, total))
+  if failed:
+    sys.exit(1)
 
 #-----------------------------------------------------------------------
 #
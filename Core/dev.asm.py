@@ -156,6 +156,7 @@
 import importlib
 from sys import argv
 from os  import getenv
+from os.path import getsize
 
 from asm import *
 import gcl0x as gcl
@@ -212,6 +213,12 @@ if ROMNAME.endswith('.asm'):
 # It defaults to '[DEV7]'
 DISPLAYNAME = defined('DISPLAYNAME', "[DEV7]")
 
+# Application packing --
+# Reorder consecutive .gt1 files in ROM to avoid filler in front of
+# their ROM directory entries, e.g. -DPACKAPPS=1. The ROM directory
+# itself keeps the command line order. Disabled by default.
+PACKAPPS = defined('PACKAPPS')
+
 
 # Listing starts here
 enableListing()
@@ -497,15 +504,20 @@ def runVcpu_new(n, ref=None):
 
   if n is None:
     n, m = 127, 0               # longest slice
+    enter = None
   else:
+    cycle(200 - n)              # Declare for the timing analysis (200 cycles per scan line)
+    enter = 200 - n + 3         # And the cycle at which ENTER runs
     n -= vCPU_overhead + 3
     assert n > 0
     n, m = n // 2 - maxTicks, n % 2
+    enter += m
   assert n < 128
   assert n >= v6502_adjust
   print('runVcpu at $%04x net cycles %3s info %s' % (pc(), (n + maxTicks) * 2, ref))
   ld([vCpuSelect],Y)            #0 Allows us to use ctrl() just before runVcpu
   st(0,[0]) if m == 1 else None #? Tick alignment
+  landing(enter) if enter is not None else None
   jmp(Y,'ENTER')                #3
   ld(n)                         #4
 
@@ -1387,6 +1399,7 @@ runVcpu_new(vBlankEnterCyc-vBlankFirstExtra-84,
 
 # New scan line
 label('vBlankEnter')
+cycle(0)
 ld([videoSync0],OUT)            #0 <New scan line start>
 label('sound1')
 ld([channel])                   #1 Advance to next sound channel
@@ -1625,6 +1638,7 @@ if WITH_512K_BOARD:
 
   fillers(until=0xff)
   label('vVisibEnter')
+  cycle(0)
   assert(vVisibEnterCyc == 200)
   ld(syncBits,OUT)                #200,0 <New scan line start>
   align(0x100, size=0x100)
@@ -1660,6 +1674,7 @@ if WITH_512K_BOARD:
   st([sample])                    #24
   ld([xout])                      #25 Gets copied to XOUT
   ld(videoTable>>8,Y)             #26 Make Y=1 for all videoABC routines!
+  landing(29)
   bra([nextVideo])                #27
   ld(syncBits,OUT)                #28 End horizontal pulse
 
@@ -1667,6 +1682,7 @@ if WITH_512K_BOARD:
   # - Fetch next Yi and store it for retrieval in the next scan lines
   # - Calculate Xi from dXi and store it as well thanks to a saved cycle.
   label('videoA')
+  cycle(29)
   ld('videoB')                    #29 1st scanline of 4 (always visible)
   st([nextVideo])                 #30
   ld([videoY],X)                  #31
@@ -1685,6 +1701,7 @@ if WITH_512K_BOARD:
   # Back porch B: second of 4 repeated scan lines
   # - Process double vres
   label('videoB')
+  cycle(29)
   ld('videoC')                    #29
   st([nextVideo])                 #30
   ld([frameY],Y)                  #31
@@ -1704,6 +1721,7 @@ if WITH_512K_BOARD:
   # - Nothing new to for video do as Yi and Xi are known,
   # - This is the time to emit and reset the next sound sample
   label('videoC')
+  cycle(29)
   ld('videoD')                    #29 3rd scanline of 4
   st([nextVideo])                 #30
   ld([sample])                    #31 New sound sample is ready (didn't fit in audio loop)
@@ -1732,6 +1750,7 @@ if WITH_512K_BOARD:
   # - Calculate the next frame index
   # - Decide if this is the last line or not
   label('videoD')                 # Default video mode
+  cycle(29)
   ld([frameX], X)                 #29 4th scanline of 4
   ld([videoY])                    #30
   suba((120-1)*2)                 #31
@@ -1768,6 +1787,7 @@ if WITH_512K_BOARD:
   # Back porch "E": after the last line
   # - Go back and and enter vertical blank (program page 2)
   label('videoE') # Exit visible area
+  cycle(29)
   ld(hi('vBlankStart'),Y)         #29 Return to vertical blank interval
   jmp(Y,'vBlankStart')            #30
   ld(syncBits)                    #31
@@ -1777,6 +1797,7 @@ if WITH_512K_BOARD:
   # Note: Sound output becomes choppier the more pixel lines are skipped
   # Note: The vertical blank driver leaves 0x80 behind in [videoSync1]
   label('videoF')
+  cycle(29)
   ld([videoSync1])                #29 Completely black pixel line
   adda(0x80)                      #30
   st([videoSync1],X)              #31
@@ -1805,6 +1826,7 @@ else:
   if WITH_128K_BOARD:
     fillers(until=0xe3)
     label('vVisibEnter')
+    cycle(0)
     assert(vVisibEnterCyc == 200)
     ld([ctrlVideo],X)             #200,0 <New scan line start>
     ctrl(X)                       #1 Reset banking to page1.
@@ -1835,6 +1857,7 @@ else:
     st([sample])                  #25
     ld([xout])                    #26
     assert(pc()&0xff == 0xff)
+    landing(29)
     bra([nextVideo])              #27
     align(0x100, size=0x100)
     ld(syncBits,OUT)              #28 End horizontal pulse
@@ -1843,6 +1866,7 @@ else:
   else:
     fillers(until=0xff)
     label('vVisibEnter')
+    cycle(0)
     assert(vVisibEnterCyc == 200)
     bra('sound3')                 #200,0 <New scan line start>
     align(0x100, size=0x100)
@@ -1852,6 +1876,7 @@ else:
   # - Fetch next Yi and store it for retrieval in the next scan lines
   # - Calculate Xi from dXi, but there is no cycle time left to store it as well
   label('videoA')
+  cycle(29)
   ld('videoB')                    #29 1st scanline of 4 (always visible)
   st([nextVideo])                 #30
   ld(videoTable>>8,Y)             #31
@@ -1862,6 +1887,7 @@ else:
   ld([Y,X])                       #36
   adda([frameX],X)                #37
   label('pixels')
+  cycle(38)
   ld([frameY],Y)                  #38
   ld(syncBits)                    #39
 
@@ -1869,6 +1895,7 @@ else:
   # Superimpose the sync signal bits to be robust against misprogramming
   for i in range(qqVgaWidth):
     ora([Y,Xpp],OUT)              #40-199 Pixel burst
+  cycle(0)
   ld(syncBits,OUT)                #0 <New scan line start> Back to black
 
   # Front porch
@@ -1904,12 +1931,14 @@ else:
   st([sample])                    #25
 
   ld([xout])                      #26 Gets copied to XOUT
+  landing(29)
   bra([nextVideo])                #27
   ld(syncBits,OUT)                #28 End horizontal pulse
 
   # Back porch B: second of 4 repeated scan lines
   # - Recompute Xi from dXi and store for retrieval in the next scan lines
   label('videoB')
+  cycle(29)
   ld('videoC')                    #29 2nd scanline of 4
   st([nextVideo])                 #30
   ld(videoTable>>8,Y)             #31
@@ -1917,6 +1946,7 @@ else:
   adda(1,X)                       #33
   ld([frameX])                    #34
   adda([Y,X])                     #35
+  landing(38)
   bra([videoModeB])               #36
   st([frameX],X)                  #37 Store in RAM and X
 
@@ -1924,6 +1954,7 @@ else:
   # - Nothing new to for video do as Yi and Xi are known,
   # - This is the time to emit and reset the next sound sample
   label('videoC')
+  cycle(29)
   ld('videoD')                    #29 3rd scanline of 4
   st([nextVideo])                 #30
   ld([sample])                    #31 New sound sample is ready (didn't fit in audio loop)
@@ -1931,6 +1962,7 @@ else:
   anda([xoutMask])                #33
   st([xout])                      #34 Update [xout] with new sample (4 channels just updated)
   st(sample, [sample])            #35 Reset for next sample
+  landing(38)
   bra([videoModeC])               #36
   ld([frameX],X)                  #37
 
@@ -1938,6 +1970,7 @@ else:
   # - Calculate the next frame index
   # - Decide if this is the last line or not
   label('videoD')                 # Default video mode
+  cycle(29)
   ld([frameX], X)                 #29 4th scanline of 4
   ld([videoY])                    #30
   suba((120-1)*2)                 #31
@@ -1945,6 +1978,7 @@ else:
   adda(120*2)                     #33 More pixel lines to go
   st([videoY])                    #34
   ld('videoA')                    #35
+  landing(38)
   bra([videoModeD])               #36
   st([nextVideo])                 #37
 
@@ -1954,12 +1988,14 @@ else:
   else:
     nop()                         #34
   ld('videoE')                    #35 No more pixel lines to go
+  landing(38)
   bra([videoModeD])               #36
   st([nextVideo])                 #37
 
   # Back porch "E": after the last line
   # - Go back and and enter vertical blank (program page 2)
   label('videoE') # Exit visible area
+  cycle(29)
   ld(hi('vBlankStart'),Y)         #29 Return to vertical blank interval
   jmp(Y,'vBlankStart')            #30
   ld(syncBits)                    #31
@@ -1969,6 +2005,7 @@ else:
   # Note: Sound output becomes choppier the more pixel lines are skipped
   # Note: The vertical blank driver leaves 0x80 behind in [videoSync1]
   label('videoF')
+  cycle(29)
   ld([videoSync1])                #29 Completely black pixel line
   adda(0x80)                      #30
   st([videoSync1],X)              #31
@@ -1983,6 +2020,7 @@ else:
   #
   # Alternative for pixel burst: faster application mode
   label('nopixels')
+  cycle(38)
   if WITH_128K_BOARD:
     ld([ctrlCopy],X)                #38
     ctrl(X)                         #39
@@ -10952,6 +10990,7 @@ vSave(0xec,vT2,vT2+1,vT3,vT3+1)
 vSave(0xf0,sysArgs,sysArgs+1,sysArgs+2,sysArgs+3)
 vSave(0xf4,sysArgs+4,sysArgs+5,sysArgs+6)
 vSave(0xf8,sysFn,sysFn+1,vFAS,vFAE,vLAX)
+landing(166+vBlankFirstExtra)   # From vIRQ#99, in vertical blank
 bra([fsmState])                 #28+28+108=164,+10=66
 ld(1,Y)                         #165,67
 label('vIRQ#166')
@@ -11704,6 +11743,7 @@ define('vSP_v7',       vSP)
 define('vSPL_v7',      vSP)
 define('vSPH_v7',      vSP+1)
 define('vTmp',         vTmp)      # Not in interface.json
+define('vTicks',       vTicks)    # Not in interface.json, for timing analysis
 define('romType',      romType)
 define('sysFn',        sysFn)
 for i in range(8):
@@ -11800,16 +11840,52 @@ def insertRomDir(name):
     st([vAC+1])                         #38
     lastRomFile = name
 
+#-----------------------------------------------------------------------
+
+def isGt1(application):
+  return application.endswith(('.gt1', '.gt1x', '.gt1z'))
+
+def placeGt1(offset, name, size):
+  """Page offset after a .gt1 file and its ROM directory entry, and filler
+
+  Mirrors insertRomDir() and ldBytes(): 251 usable words per page"""
+  filler = 0
+  if name[0] != '_':
+    if offset >= 251-14:                # Entry would cross the page
+      filler, offset = 251 - offset, 0
+    offset += 14
+  return (offset + size) % 251, filler
+
+def fillerGt1(offset, files):
+  """Total filler for placing .gt1 files in the given order"""
+  total = 0
+  for name, _, size in files:
+    offset, filler = placeGt1(offset, name, size)
+    total += filler
+  return total
+
+def packGt1(offset, files):
+  """Order .gt1 files for little filler in front of directory entries
+
+  Greedy: take the file that needs no filler now and leaves room for
+  the next entry, the largest one first"""
+  files, order = list(files), []
+  while files:
+    def cost(file):
+      nextOffset, filler = placeGt1(offset, file[0], file[2])
+      return filler, nextOffset >= 251-14, -file[2]
+    file = min(files, key=cost)
+    files.remove(file)
+    order.append(file)
+    offset, _ = placeGt1(offset, file[0], file[2])
+  return order
+
 #-----------------------------------------------------------------------
 #       Embedded programs must be given on the command line
 #-----------------------------------------------------------------------
 
-if pc()&255 >= 251:                     # Don't start in a trampoline region
-  align(0x100)
-
+applications = []
 for application in argv[1:]:
-    print()
-
     # Determine label
     if '=' in application:
         # Explicit label given as 'label=filename'
@@ -11818,6 +11894,43 @@ for application in argv[1:]:
         # Label derived from filename itself
         name = application.rsplit('.', 1)[0] # Remove extension
         name = name.rsplit('/', 1)[-1]       # Remove path
+    applications.append((name, application))
+
+# Each ROM directory entry describes the file before it in command line
+# order, even when files are placed in a different order in ROM
+romDirPrevious = {}
+for name, application in applications:
+    if name[0] != '_' and (isGt1(application) or application.endswith('.gcl')):
+        romDirPrevious[name] = lastRomFile
+        lastRomFile = name
+romDirLast, lastRomFile = lastRomFile, ''
+
+if pc()&255 >= 251:                     # Don't start in a trampoline region
+  align(0x100)
+
+reclaimed = 0
+for i in range(len(applications)):
+    print()
+
+    # Place a run of consecutive .gt1 files
+    if PACKAPPS and isGt1(applications[i][1]) and (i == 0 or not isGt1(applications[i-1][1])):
+        j = i
+        while j < len(applications) and isGt1(applications[j][1]):
+            j += 1
+        files = [(name, application, getsize(application))
+                 for name, application in applications[i:j]]
+        packed = packGt1(pc()&255, files)
+        before, after = fillerGt1(pc()&255, files), fillerGt1(pc()&255, packed)
+        if after < before:
+            applications[i:j] = [(name, application) for name, application, _ in packed]
+            reclaimed += before - after
+        print('Packing %d .gt1 files at $%04x: %d filler words, %d in command line order' %
+              (j - i, pc(), min(before, after), before))
+        print()
+
+    name, application = applications[i]
+    if name in romDirPrevious:
+        lastRomFile = romDirPrevious[name]
     print('Processing file %s label %s' % (application, name))
 
     C('+-----------------------------------+')
@@ -11825,7 +11938,7 @@ for application in argv[1:]:
     C('+-----------------------------------+')
 
     # Pre-compiled GT1 files
-    if application.endswith(('.gt1', '.gt1x', '.gt1z')):
+    if isGt1(application):
         print('Load type .gt1 at $%04x' % pc())
         with open(application, 'rb') as f:
             raw = bytearray(f.read())
@@ -11833,10 +11946,7 @@ for application in argv[1:]:
             align(0x100,250)
         insertRomDir(name)
         label(name)
-        for byte in raw:
-            ld(byte)
-            if pc() & 255 == 251:
-                trampoline()
+        ldBytes(raw)
 
     # GCL files
     #----------------------------------------------------------------
@@ -11873,11 +11983,8 @@ for application in argv[1:]:
         raw = bytearray(f.read())
         f.close()
         label(name)
-        for i in range(len(raw)):
-            if i&255 < 251:
-                ld(raw[i])
-            elif pc()&255 == 251:
-                trampoline()
+        # Each 256 byte chunk leaves out the last 5 bytes for the trampoline
+        ldBytes(raw[i] for i in range(len(raw)) if i&255 < 251)
 
     # Other files
     elif application.endswith('.gtb'):
@@ -11890,6 +11997,11 @@ for application in argv[1:]:
     C('End of %s, size %d' % (application, pc() - symbol(name)))
     print(' Size %s' % (pc() - symbol(name)))
 
+lastRomFile = romDirLast
+if PACKAPPS:
+  print()
+  print('Packing reclaimed %d ROM words' % reclaimed)
+
 #-----------------------------------------------------------------------
 # ROM directory
 #-----------------------------------------------------------------------
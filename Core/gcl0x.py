@@ -6,12 +6,108 @@
 # XXX Give warning when a variable is not both written and read
 
 from asm import *
+import functools
+import re
 import string
 import sys
+import threading
 from pathlib import Path
 
+# Outside comments a line is a sequence of words, separated by white
+# space and by the characters for comments and blocks. Inside comments
+# only the comment braces matter, for nesting.
+_tokens = re.compile(r'[^\s{}\[\]]+|[{}\[\]]')
+_braces = re.compile(r'[{}]')
+
+# Simple keywords
+_keywords = {
+  'def':       lambda self: self.emitDef(),
+  'do':        lambda self: self.emitDo(),
+  'loop':      lambda self: self.emitLoop(),
+  'if<>0':     lambda self: self.emitIf('EQ'),
+  'if=0':      lambda self: self.emitIf('NE'),
+  'if>=0':     lambda self: self.emitIf('LT'),
+  'if<=0':     lambda self: self.emitIf('GT'),
+  'if>0':      lambda self: self.emitIf('LE'),
+  'if<0':      lambda self: self.emitIf('GE'),
+  'if<>0loop': lambda self: self.emitIfLoop('NE'),
+  'if=0loop':  lambda self: self.emitIfLoop('EQ'),
+  'if>0loop':  lambda self: self.emitIfLoop('GT'),
+  'if<0loop':  lambda self: self.emitIfLoop('LT'),
+  'if>=0loop': lambda self: self.emitIfLoop('GE'),
+  'if<=0loop': lambda self: self.emitIfLoop('LE'),
+  'else':      lambda self: self.emitElse(),
+  'call':      lambda self: self.emitCall(),
+  'push':      lambda self: self.emitOp('PUSH'),
+  'pop':       lambda self: self.emitOp('POP'),
+  'ret':       lambda self: self.emitRet(),
+  'peek':      lambda self: self.emitOp('PEEK'),
+  'deek':      lambda self: self.emitOp('DEEK'),
+}
+
+# Operators that take a constant and only emit one instruction
+_conOps = {
+  ';':    'LDW',
+  ',':    'LD',
+  '.':    'ST',
+  '&':    'ANDI',
+  '|':    'ORI',
+  '^':    'XORI',
+  '+':    'ADDI',
+  '-':    'SUBI',
+  '% =':  'STLW',
+  '% ':   'LDLW',
+  '++':   'ALLOC',
+  '< ++': 'INC',
+  '?':    'LUP',  #self.depr('i?', 'i??')
+  '??':   'LUP',
+  # Deprecated syntax
+  '<++':  'INC',  #self.depr('i<++', '<i++')
+  '%=':   'STLW', #self.depr('i%=', '%i=')
+  '%':    'LDLW', #self.depr('i%', %i')
+}
+
+# Operators that take a variable and only emit one instruction, with the
+# offset for the variable
+_varOps = {
+  '.':    ('POKE', 0),
+  ':':    ('DOKE', 0),
+  '< ,':  ('LD',   0),
+  '> ,':  ('LD',   1),
+  '< .':  ('ST',   0),
+  '> .':  ('ST',   1),
+  '&':    ('ANDW', 0),
+  '|':    ('ORW',  0),
+  '^':    ('XORW', 0),
+  '+':    ('ADDW', 0),
+  '-':    ('SUBW', 0),
+  '< ++': ('INC',  0),
+  '> ++': ('INC',  1),
+  '!':    ('CALL', 0),
+  # Deprecated syntax
+  '<++':  ('INC',  0), #self.depr('X<++', '<X++')
+  '>++':  ('INC',  1), #self.depr('X>++', '>X++')
+  '<,':   ('LD',   0), #self.depr('X<,', '<X,')
+  '>,':   ('LD',   1), #self.depr('X>,', '>X,')
+  '<.':   ('ST',   0), #self.depr('X<.', '<X.')
+  '>.':   ('ST',   1), #self.depr('X>.', '>X.')
+}
+
+# Maximum cycles for each vCPU instruction, as documented in ROMv6.
+# SYS is not here: its cost is its operand (see sysTicks())
+_cycles = {
+  'LDWI':  20, 'LD':    22, 'CMPHS_v5': 28, 'LDW':   20, 'STW':  20,
+  'BCC':   28, 'LDI':   16, 'ST':    16, 'POP':   26, 'PUSH':  26,
+  'LUP':   26, 'ANDI':  22, 'CALLI_v5': 28, 'ORI':   14, 'XORI': 14,
+  'BRA':   14, 'INC':   20, 'CMPHU_v5': 28, 'ADDW':  28, 'PEEK':  26,
+  'SUBW':  28, 'DEF':   24, 'CALL':  26, 'ALLOC': 14, 'ADDI':  28,
+  'SUBI':  28, 'LSLW':  28, 'STLW':  26, 'LDLW':  26, 'POKE':  28,
+  'DOKE':  28, 'DEEK':  28, 'ANDW':  28, 'ORW':   28, 'XORW':  26,
+  'RET':   16,
+}
+
 class Program:
-  def __init__(self, name, forRom=True, romName=None):
+  def __init__(self, name, forRom=True, romName=None, reportCycles=False):
     self.name = name     # For defining unique labels in global symbol table
     self.forRom = forRom # Inject trampolines if compiling for ROM XXX why not do that outside?
     self.comments = []   # Stack of line numbers
@@ -32,6 +128,12 @@ class Program:
     self.execute = None
     self.needPatch = False
     self.lengths = {} # block -> length, or var -> length
+    self.reportCycles = reportCycles # Print static cycle counts at the end
+    self.cycles = {} # address of `def' (None outside) -> [cycles, loop bodies]
+    self.cycleCount = 0 # Running total of static cycles
+    self.doCycles = {} # blockId -> cycle count at `do'
+    self.closedDefs = {} # block -> address of last closed `def', for names
+    self.defNames = {} # address of `def' -> name, for the cycle report
     # XXX Provisional method to load mnemonics
     try:
       loadBindings(Path('Core') / 'v6502.json')
@@ -51,41 +153,44 @@ class Program:
     """Process a line by tokenizing and processing the words"""
 
     self.lineNumber += 1
-    nextWord = ''
+    pos = 0
 
-    for nextChar in line:
+    while True:
       if len(self.comments) > 0:
         # Inside comments anything goes
-        if nextChar == '{': self.comments.append(self.lineNumber)
-        if nextChar == '}': self.comments.pop()
-      elif nextChar not in '{}[]':
-        if nextChar.isspace():
-          self.word(nextWord)
-          nextWord = ''
-        else:
-          nextWord += nextChar
+        m = _braces.search(line, pos)
+        if not m:
+          break
+        if m.group() == '{': self.comments.append(self.lineNumber)
+        else:                self.comments.pop()
       else:
-        self.word(nextWord)
-        nextWord = ''
-        if nextChar == '{': self.comments.append(self.lineNumber)
-        elif nextChar == '}': self.error('Spurious %s' % repr(nextChar))
-        elif nextChar == '[':
-           self.openBlocks.append(self.nextBlockId)
-           self.elses[self.nextBlockId] = 0
-           self.nextBlockId += 1
-        elif nextChar == ']':
-          if len(self.openBlocks) <= 1:
-            self.error('Block close without open')
-          b = self.openBlocks.pop()
-          define('__%s_%d_cond%d__' % (self.name, b, self.elses[b]), prev(self.vPC))
-          del self.elses[b]
-          if b in self.defs:
-            self.lengths[self.thisBlock()] = self.vPC - self.defs[b] + 2
-            define('__%s_%#04x_def__' % (self.name, self.defs[b]), prev(self.vPC))
-            del self.defs[b]
-        elif nextChar == '(': pass
-        elif nextChar == ')': pass
-    self.word(nextWord)
+        m = _tokens.search(line, pos)
+        if not m:
+          break
+        token = m.group()
+        if   token == '{': self.comments.append(self.lineNumber)
+        elif token == '}': self.error('Spurious %s' % repr(token))
+        elif token == '[': self.openBlock()
+        elif token == ']': self.closeBlock()
+        else:              self.word(token)
+      pos = m.end()
+
+  def openBlock(self):
+    self.openBlocks.append(self.nextBlockId)
+    self.elses[self.nextBlockId] = 0
+    self.nextBlockId += 1
+
+  def closeBlock(self):
+    if len(self.openBlocks) <= 1:
+      self.error('Block close without open')
+    b = self.openBlocks.pop()
+    define('__%s_%d_cond%d__' % (self.name, b, self.elses[b]), prev(self.vPC))
+    del self.elses[b]
+    if b in self.defs:
+      self.lengths[self.thisBlock()] = self.vPC - self.defs[b] + 2
+      self.closedDefs[self.thisBlock()] = self.defs[b]
+      define('__%s_%#04x_def__' % (self.name, self.defs[b]), prev(self.vPC))
+      del self.defs[b]
 
   def end(self):
     """Signal end of program"""
@@ -98,6 +203,8 @@ class Program:
     self.putInRomTable(0) # Zero marks the end of stream
     if self.lineNumber > 0:
       self.dumpVars()
+      if self.reportCycles:
+        self.dumpCycles()
 
   def dumpVars(self):
     print(' Variables count %d bytes %d end $%04x' % (len(self.vars), 2*len(self.vars), zpByte(0)))
@@ -111,6 +218,20 @@ class Program:
       line += ' ' + var
     print(line)
 
+  def dumpCycles(self):
+    # Static cycle counts: every instruction taken once, SYS by its operand
+    print(' Cycles total %d, per def with loop bodies' % self.cycleCount)
+    line = ' :'
+    for address in sorted(self.cycles, key=lambda a: -1 if a is None else a):
+      cycles, loops = self.cycles[address]
+      name = self.defNames.get(address, '$%04x' % address) if has(address) else '(main)'
+      name += ' [%d%s]' % (cycles, ''.join(' %d' % c for c in loops))
+      if len(line + name) + 1 > 72:
+        print(line)
+        line = ' :'
+      line += ' ' + name
+    print(line)
+
   def word(self, word):
     # Process a GCL word and emit its corresponding vCPU code
     if len(word) == 0:
@@ -123,28 +244,8 @@ class Program:
         self.version = word
       else:
         self.error('Invalid GCL version')
-    elif word == 'def':       self.emitDef()
-    elif word == 'do':        self.loops[self.thisBlock()] = self.vPC
-    elif word == 'loop':      self.emitLoop()
-    elif word == 'if<>0':     self.emitIf('EQ')
-    elif word == 'if=0':      self.emitIf('NE')
-    elif word == 'if>=0':     self.emitIf('LT')
-    elif word == 'if<=0':     self.emitIf('GT')
-    elif word == 'if>0':      self.emitIf('LE')
-    elif word == 'if<0':      self.emitIf('GE')
-    elif word == 'if<>0loop': self.emitIfLoop('NE')
-    elif word == 'if=0loop':  self.emitIfLoop('EQ')
-    elif word == 'if>0loop':  self.emitIfLoop('GT')
-    elif word == 'if<0loop':  self.emitIfLoop('LT')
-    elif word == 'if>=0loop': self.emitIfLoop('GE')
-    elif word == 'if<=0loop': self.emitIfLoop('LE')
-    elif word == 'else':      self.emitElse()
-    elif word == 'call':      self.emitOp('CALL').emit(symbol('vAC'), '%04x vAC' % prev(self.vPC, 1))
-    elif word == 'push':      self.emitOp('PUSH')
-    elif word == 'pop':       self.emitOp('POP')
-    elif word == 'ret':       self.emitOp('RET'); self.needPatch = self.needPatch or len(self.openBlocks) == 1 # Top-level use of 'ret' --> apply patch
-    elif word == 'peek':      self.emitOp('PEEK')
-    elif word == 'deek':      self.emitOp('DEEK')
+    elif word in _keywords:
+      _keywords[word](self)
     else:
       var, con, op = self.parseWord(word)
 
@@ -162,32 +263,19 @@ class Program:
             self.emitOp('LDI')
           else:
             self.emitOp('LDWI').emit(lo(con)); con = hi(con)
+        elif op in _conOps: self.emitOp(_conOps[op])
         elif op == '*= ':  self.org(con); con = None
-        elif op == ';':    self.emitOp('LDW')
         elif op == '=':    self.emitOp('STW'); self.depr('i=', 'i:')
         elif op == ':' and con < 256: self.emitOp('STW')
-        elif op == ',':    self.emitOp('LD')
-        elif op == '.':    self.emitOp('ST')
-        elif op == '&':    self.emitOp('ANDI')
-        elif op == '|':    self.emitOp('ORI')
-        elif op == '^':    self.emitOp('XORI')
-        elif op == '+':    self.emitOp('ADDI')
-        elif op == '-':    self.emitOp('SUBI')
-        elif op == '% =':  self.emitOp('STLW')
-        elif op == '% ':   self.emitOp('LDLW')
         elif op == '--':   self.emitOp('ALLOC'); con = 256-con if con else 0
-        elif op == '++':   self.emitOp('ALLOC')
-        elif op == '< ++': self.emitOp('INC')
         elif op == '> ++': self.emitOp('INC'); con += 1
-        elif op == '!!':   self.emitOp('SYS'); con = self.sysTicks(con)
+        elif op == '!!':   self.emitOp('SYS', con); con = self.sysTicks(con)
         elif op == '!':
           if isinstance(con, int) and 0 <= con < 256:
             # XXX Deprecate in gcl1, replace with i!!
-            self.emitOp('SYS'); con = self.sysTicks(con);self.depr('i!', 'i!!')
+            self.emitOp('SYS', con); con = self.sysTicks(con);self.depr('i!', 'i!!')
           else:
             self.emitOp('CALLI_v5').emit(lo(con)); con = hi(con)
-        elif op == '?':    self.emitOp('LUP');          #self.depr('i?', 'i??')
-        elif op == '??':   self.emitOp('LUP')
         elif op == '# ':   self.emitOp(con); con = None # Silent truncation
         elif op == '#< ':  self.emitOp(con); con = None
         elif op == '#> ':  con = hi(con); assert self.segStart != self.vPC # XXX Conflict
@@ -199,10 +287,7 @@ class Program:
         # Deprecated syntax
         elif op == ':':    self.org(con); con = None;   #self.depr('ii:', '*=ii')
         elif op == '#':    con &= 255;                  #self.depr('i#', '#i')
-        elif op == '<++':  self.emitOp('INC');          #self.depr('i<++', '<i++')
         elif op == '>++':  self.emitOp('INC'); con += 1 #self.depr('i>++', '>i++')
-        elif op == '%=':   self.emitOp('STLW');         #self.depr('i%=', '%i=')
-        elif op == '%':    self.emitOp('LDLW');         #self.depr('i%', %i')
         else:
           self.error("Invalid operator '%s' with constant" % op)
         if has(con):
@@ -215,20 +300,9 @@ class Program:
         elif op == '=':    self.emitOp('STW'); self.updateDefInfo(var)
         elif op == ',':    self.emitOp('LDW').emitVar(var).emitOp('PEEK'); var = None
         elif op == ';':    self.emitOp('LDW').emitVar(var).emitOp('DEEK'); var = None
-        elif op == '.':    self.emitOp('POKE')
-        elif op == ':':    self.emitOp('DOKE')
-        elif op == '< ,':  self.emitOp('LD')
-        elif op == '> ,':  self.emitOp('LD'); offset = 1
-        elif op == '< .':  self.emitOp('ST')
-        elif op == '> .':  self.emitOp('ST'); offset = 1
-        elif op == '&':    self.emitOp('ANDW')
-        elif op == '|':    self.emitOp('ORW')
-        elif op == '^':    self.emitOp('XORW')
-        elif op == '+':    self.emitOp('ADDW')
-        elif op == '-':    self.emitOp('SUBW')
-        elif op == '< ++': self.emitOp('INC')
-        elif op == '> ++': self.emitOp('INC'); offset = 1
-        elif op == '!':    self.emitOp('CALL')
+        elif op in _varOps:
+          ins, offset = _varOps[op]
+          self.emitOp(ins)
         elif op == '`':    self.emitQuote(var);                 var = None
         elif op == '=*':   self.defSymbol(var, self.vPC);       var = None
         elif op == '# ':   self.emitImm(var);                   var = None
@@ -236,13 +310,6 @@ class Program:
         elif op == '#> ':  self.emitImm(var, half=hi);          var = None
         elif op == '## ':  self.emitImm(var).emit(hi(var[1:])); var = None
         elif op == '#@ ':  offset = -self.vPC-1 # PC relative, 6502 style
-        # Deprecated syntax
-        elif op == '<++':  self.emitOp('INC');             #self.depr('X<++', '<X++')
-        elif op == '>++':  self.emitOp('INC'); offset = 1; #self.depr('X>++', '>X++')
-        elif op == '<,':   self.emitOp('LD');              #self.depr('X<,', '<X,')
-        elif op == '>,':   self.emitOp('LD'); offset = 1;  #self.depr('X>,', '>X,')
-        elif op == '<.':   self.emitOp('ST');              #self.depr('X<.', '<X.')
-        elif op == '>.':   self.emitOp('ST'); offset = 1;  #self.depr('X>.', '>X.')
         else:
           self.error("Invalid operator '%s' with variable or symbol '%s'" % (op, var))
         if has(var):
@@ -254,63 +321,11 @@ class Program:
   def parseWord(self, word):
     # Break word into pieces
 
-    word += '\0' # Avoid checking len() everywhere
-    sign = None
-    name, number, op = None, None, ''
-
     if word[0] == '`':
       # Quoted word
-      name, op = word[1:-1], word[0]
-      return name, number, op
-
-    ix = 0
-    prefixes = ['%', '#', '<', '>', '*', '=', '@']
-    if word[ix] in prefixes:
-      # Prefix operators
-      while word[ix] in prefixes:
-        op += word[ix]
-        ix += 1
-      op += ' ' # Space to demarcate prefix operators
-
-    if word[ix].isalpha() or word[ix] in ['&', '\\', '_']:
-      # Named variable or named constant
-      name = word[ix]
-      ix += 1
-      while word[ix].isalnum() or word[ix] == '_':
-        name += word[ix]
-        ix += 1
-
-    if word[ix] == '=':
-      # Infix symbol definition
-      op += word[ix]
-      # op += ' ' # Space to demarcate infix operator
-      ix += 1
-
-    if word[ix] in ['-', '+']:
-      # Number sign
-      sign = word[ix]
-      ix += 1
+      return word[1:], None, word[0]
 
-    if word[ix] == '$' and word[ix+1] in string.hexdigits:
-      # Hexadecimal number
-      jx = ix+1
-      number = 0
-      while word[jx] in string.hexdigits:
-        o = string.hexdigits.index(word[jx])
-        number = 16*number + (o if o<16 else o-6)
-        jx += 1
-      ix = jx if jx-ix > 1 else 0
-    elif word[ix].isdigit():
-      # Decimal number
-      number = 0
-      while word[ix].isdigit():
-        number = 10*number + ord(word[ix]) - ord('0')
-        ix += 1
-    elif has(sign):
-      op += sign
-      sign = None
-    else:
-      pass
+    name, number, sign, op = splitWord(word)
 
     # Resolve '&_symbol' as the number it represents
     if has(name) and name[0] == '&':
@@ -335,7 +350,6 @@ class Program:
       else:
         self.error('Unable to negate')
 
-    op += word[ix:-1]                   # Also strips sentinel '\0'
     return (name, number, op if len(op)>0 else None)
 
   def sysTicks(self, con):
@@ -373,19 +387,38 @@ class Program:
     # Heuristically track `def' lengths for reporting on stdout
     if var not in self.lengths and self.thisBlock() in self.lengths:
       self.lengths[var] = self.lengths[self.thisBlock()]
+      self.defNames.setdefault(self.closedDefs[self.thisBlock()], var)
     else:
       self.lengths[var] = None # No def lengths can be associated
 
+  def emitDo(self):
+    self.loops[self.thisBlock()] = self.vPC
+    self.doCycles[self.thisBlock()] = self.cycleCount
+
+  def innermostDef(self):
+    # Address of the innermost open `def', or None outside
+    defs = [b for b in self.openBlocks if b in self.defs]
+    return self.defs[defs[-1]] if defs else None
+
+  def emitCall(self):
+    self.emitOp('CALL').emit(symbol('vAC'), '%04x vAC' % prev(self.vPC, 1))
+
+  def emitRet(self):
+    self.emitOp('RET')
+    self.needPatch = self.needPatch or len(self.openBlocks) == 1 # Top-level use of 'ret' --> apply patch
+
   def emitLoop(self):
       to = [b for b in self.openBlocks if b in self.loops]
       if len(to) == 0:
         self.error('Loop without do')
-      to = self.loops[to[-1]]
+      b = to[-1]
+      to = self.loops[b]
       to = prev(to)
       if self.vPC>>8 != to>>8:
         self.error('Loop crosses page boundary')
       self.emitOp('BRA')
       self.emit(to&255)
+      self.loopCycles(b)
 
   def emitIf(self, cond):
       self.emitOp('BCC')
@@ -397,13 +430,22 @@ class Program:
       to = [blockId for blockId in self.openBlocks if blockId in self.loops]
       if len(to) == 0:
         self.error('Loop without do')
-      to = self.loops[to[-1]]
+      b = to[-1]
+      to = self.loops[b]
       to = prev(to)
       if self.vPC>>8 != to>>8:
         self.error('Loop to different page')
       self.emitOp('BCC')
       self.emitOp(cond)
       self.emit(to&255)
+      self.loopCycles(b)
+
+  def loopCycles(self, b):
+    # Record the static cycles of a loop body, from `do' up to here
+    if not self.reportCycles:
+      return
+    cycles = self.cycles.setdefault(self.innermostDef(), [0, []])
+    cycles[1].append(self.cycleCount - self.doCycles[b])
 
   def emitElse(self):
       self.emitOp('BRA')
@@ -413,11 +455,17 @@ class Program:
       define('__%s_%d_cond%d__' % (self.name, b, i), prev(self.vPC))
       self.elses[b] = i+1
 
-  def emitOp(self, ins):
-    # Emit vCPU opcode
+  def emitOp(self, ins, cycles=None):
+    # Emit vCPU opcode, and count its cycles (condition codes have none)
     self.prepareSegment()
     self.putInRomTable(lo(ins), '%04x %s' % (self.vPC, ins))
     self.vPC += 1
+    if self.reportCycles:
+      if cycles is None and isinstance(ins, str):
+        cycles = _cycles.get(ins)
+      if cycles:
+        self.cycleCount += cycles
+        self.cycles.setdefault(self.innermostDef(), [0, []])[0] += cycles
     return self
 
   def emitVar(self, var, offset=0):
@@ -546,7 +594,168 @@ class Program:
     if name[0] != '_':
       self.error('Symbol \'%s\' must begin with underscore (\'_\')' % name)
     define(name[1:], value)
+    b = self.thisBlock()
+    if b in self.defs and value == self.defs[b] + 1:
+      self.defNames.setdefault(self.defs[b], name[1:]) # Label of a `def' body
+
+@functools.lru_cache(maxsize=4096)
+def splitWord(word):
+  # Break word into name, number, sign and operator. There are no symbol
+  # lookups here, so the result only depends on the word and can be cached
+  word += '\0' # Avoid checking len() everywhere
+  sign = None
+  name, number, op = None, None, ''
+  ix = 0
+
+  prefixes = ['%', '#', '<', '>', '*', '=', '@']
+  if word[ix] in prefixes:
+    # Prefix operators
+    while word[ix] in prefixes:
+      op += word[ix]
+      ix += 1
+    op += ' ' # Space to demarcate prefix operators
+
+  if word[ix].isalpha() or word[ix] in ['&', '\\', '_']:
+    # Named variable or named constant
+    name = word[ix]
+    ix += 1
+    while word[ix].isalnum() or word[ix] == '_':
+      name += word[ix]
+      ix += 1
+
+  if word[ix] == '=':
+    # Infix symbol definition
+    op += word[ix]
+    # op += ' ' # Space to demarcate infix operator
+    ix += 1
+
+  if word[ix] in ['-', '+']:
+    # Number sign
+    sign = word[ix]
+    ix += 1
+
+  if word[ix] == '$' and word[ix+1] in string.hexdigits:
+    # Hexadecimal number
+    jx = ix+1
+    number = 0
+    while word[jx] in string.hexdigits:
+      o = string.hexdigits.index(word[jx])
+      number = 16*number + (o if o<16 else o-6)
+      jx += 1
+    ix = jx if jx-ix > 1 else 0
+  elif word[ix].isdigit():
+    # Decimal number
+    number = 0
+    while word[ix].isdigit():
+      number = 10*number + ord(word[ix]) - ord('0')
+      ix += 1
+  elif has(sign):
+    op += sign
+    sign = None
+  else:
+    pass
+
+  op += word[ix:-1]                   # Also strips sentinel '\0'
+  return name, number, sign, op
 
 def prev(address, step=2):
   # Take vPC two bytes back, wrap around if needed to stay on page
   return (address & ~255) | ((address-step) & 255)
+
+#-----------------------------------------------------------------------
+#       Library interface
+#-----------------------------------------------------------------------
+
+# The assembler keeps the state of the current Assembler in module
+# globals, so only one compilation can run at a time
+_lock = threading.Lock()
+
+class Gt1Image:
+  """GT1 object file contents as made by compileGcl()"""
+  def __init__(self, segments, execute, vars=None):
+    self.segments = segments # List of (address, bytes) in file order
+    self.execute = execute   # Execution address
+    self.vars = vars or {}   # GCL variable name -> zero page address
+
+  def __bytes__(self):
+    data = bytearray()
+    for address, segment in self.segments:
+      data += bytes([address>>8, address&255, len(segment)&255]) + segment
+    return bytes(data + bytes([0, self.execute>>8, self.execute&255]))
+
+  def merged(self):
+    """Same image with adjacent segments joined, as far as pages allow"""
+    segments = self.segments
+    ranges = sorted((a, a + len(segment)) for a, segment in segments)
+    if all(end <= start for (_, end), (start, _) in zip(ranges, ranges[1:])):
+      # Without overlap the load order doesn't matter. Sorting also keeps
+      # a zero-page segment first, as the format requires
+      segments = sorted(segments)
+    result = []
+    for address, segment in segments:
+      start, data = result[-1] if result else (None, b'')
+      if has(start) and start + len(data) == address and address & 255:
+        result[-1] = start, data + segment # Continues in the same page
+      else:
+        result.append((address, segment))
+    return Gt1Image(result, self.execute, self.vars)
+
+  def loaderFrames(self):
+    # Video frames the Loader application needs to receive the image over
+    # the serial link: a frame carries up to 60 bytes of a segment, after
+    # each segment one frame is skipped to reset the checksum, and a last
+    # frame carries the execute command (see sendGt1Segment() in BabelFish)
+    return sum((len(segment) + 59)//60 + 1 for _, segment in self.segments) + 1
+
+def compileGcl(source, org=None, zpStart=None, bindings='interface.json',
+               name='Main', filename=None, reportCycles=False):
+  """Compile GCL source text into a Gt1Image
+
+  The bindings are a file name, a list of them, or a dict with symbols.
+  The files are parsed only once per process (see loadBindings()). The
+  code and variables start at userCode and userVars if no org or zpStart
+  is given. The compilation runs in its own Assembler, so it leaves the
+  current one alone. Errors raise SystemExit, just as on the command line.
+  With reportCycles, the static cycle counts per def are printed as well.
+  """
+  with _lock, Assembler():
+    if isinstance(bindings, dict):
+      for key, value in bindings.items():
+        define(key, value)
+    else:
+      for symfile in [bindings] if isinstance(bindings, (str, Path)) else bindings:
+        loadBindings(symfile)
+
+    program = Program(name, forRom=False, reportCycles=reportCycles)
+    program.filename = filename
+    program.org(org if has(org) else symbol('userCode'))
+    align(1)          # Forces default maximum ROM size
+    zpReset(zpStart if has(zpStart) else symbol('userVars'))
+    for line in source.splitlines(True):
+      program.line(line)
+    program.end()
+    end()
+    data = getRom1()
+
+    # Split the ROM table into segments, up to the terminating zero
+    segments, i = [], 0
+    while i+1 < len(data):
+      address, length = data[i]<<8 | data[i+1], data[i+2] or 256
+      segments.append((address, bytes(data[i+3:i+3+length])))
+      i += 3 + length
+
+  address = program.execute
+
+  # Inject patch for reliable start using ROM v1 Loader application
+  # See: https://forum.gigatron.io/viewtopic.php?p=27#p27
+  if program.needPatch:
+    patchArea = 0x5b86 # Somewhere after the ROMv1 Loader's buffer
+    print('Apply patch $%04x' % patchArea)
+    segments.append((patchArea, bytes([
+      0x11, address&255, address>>8,    # LDWI address
+      0x2b, 0x1a,                       # STW  vLR
+      0xff,                             # RET
+    ])))
+    address = patchArea
+
+  return Gt1Image(segments, address, dict(program.vars))
@@ -0,0 +1,5 @@
+import pathlib
+import sys
+
+# The tests import asm, gcl0x and vasm from Core, like the ROM builds do
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
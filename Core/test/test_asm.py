@@ -0,0 +1,147 @@
+from importlib import reload
+
+import pytest
+
+import asm
+
+
+def setup_function():
+    reload(asm)
+
+
+def test_program_size_limit(monkeypatch):
+    """Emitting past 64K words should fail, even if the error is caught"""
+    messages = []
+    monkeypatch.setattr(asm, "highlight", messages.append)
+    asm.align(1)
+    with pytest.raises(IndexError):
+        asm.ldBytes(bytes(0x10000))
+    assert messages == ["Error: Program size limit exceeded"]
+    assert asm.pc() == 0x10000
+
+
+def test_assemblers():
+    """Each assembler should keep its own symbols, defines and ROM"""
+    a, b = asm.Assembler(), asm.Assembler(defines={"WITH_X": 1})
+    with a:
+        asm.align(1)
+        asm.label("start")
+        asm.ld(1)
+        with b:
+            asm.align(1)
+            asm.ld(2)
+            asm.ld(3)
+            assert asm.symbol("start") is None
+            assert asm.defined("WITH_X") == 1
+        assert asm.pc() == 1
+        assert asm.symbol("start") == 0
+        assert asm.defined("WITH_X") is None
+        asm.ld(4)
+    with b:
+        assert bytes(asm.getRom1()) == bytes([2, 3])
+    with a:
+        assert bytes(asm.getRom1()) == bytes([1, 4])
+    assert asm.pc() == 0
+
+
+def _assemble(offset, code):
+    with asm.Assembler():
+        asm.align(1)
+        for _ in range(offset):
+            asm.nop()
+        code()
+        return bytes(asm._rom[: 2 * asm.pc()])
+
+
+def test_ldBytes():
+    """ldBytes should equal ld() for every byte, with trampolines"""
+
+    def slow(data):
+        for byte in data:
+            asm.ld(byte)
+            if asm.pc() & 255 == 251:
+                asm.trampoline()
+
+    for data in [bytes(range(256)) * 3, bytes(251)]:
+        for offset in [0, 100, 250, 251, 253]:
+            rom = _assemble(offset, lambda: asm.ldBytes(data))
+            assert rom == _assemble(offset, lambda: slow(data))
+
+
+def _timing(monkeypatch, code):
+    """Warnings from the timing analysis of a small program"""
+    messages = []
+    monkeypatch.setattr(asm, "highlight", messages.append)
+    with asm.Assembler():
+        asm.align(1)
+        asm.define("vTicks", 0x15)
+        asm.label("NEXT")
+        asm.nop()
+        code()
+        asm.end()
+        asm._checkTiming()
+    return messages
+
+
+def _sys(nops):
+    # Starts at cycle 15, and arrives at NEXT after 3 more instructions
+    asm.label("SYS_Test_22")
+    for _ in range(nops):
+        asm.nop()
+    asm.ld(asm.hi("NEXT"), asm.Y)
+    asm.jmp(asm.Y, "NEXT")
+    asm.nop()
+
+
+def test_sys_duration(monkeypatch):
+    """A SYS function may not take longer than its name says"""
+    assert _timing(monkeypatch, lambda: _sys(4)) == []
+    assert _timing(monkeypatch, lambda: _sys(5)) == [
+        "Warning: SYS_Test_22 takes up to 23 cycles"
+    ]
+
+
+def _video(nops, land):
+    asm.label("videoA")
+    asm.cycle(0)
+    for _ in range(nops):
+        asm.nop()
+    asm.label("videoB")
+    asm.cycle(5)
+    asm.landing(land)
+    asm.bra(asm.AC)  # To an unknown address, after the delay slot
+    asm.nop()
+
+
+def test_video_timing(monkeypatch):
+    """Paths between declared cycles must take exactly the difference,
+    and jumps to unknown addresses must land at the declared cycle"""
+    assert _timing(monkeypatch, lambda: _video(5, 7)) == []
+    assert _timing(monkeypatch, lambda: _video(6, 7)) == [
+        "Warning: path from videoA (cycle 0) arrives at videoB"
+        " at cycle 6 instead of 5"
+    ]
+    assert _timing(monkeypatch, lambda: _video(5, 8)) == [
+        "Warning: path from videoB (cycle 5) lands from videoB"
+        " at cycle 7 instead of 8"
+    ]
+
+
+def test_video_timing_branch(monkeypatch):
+    """Both ways of a branch on an unknown value count"""
+
+    def code():
+        asm.label("videoA")
+        asm.cycle(0)
+        asm.bne("videoB")  # Skips one of the nops, or not
+        asm.nop()
+        asm.nop()
+        asm.label("videoB")
+        asm.cycle(3)
+        asm.nop()
+
+    assert _timing(monkeypatch, code) == [
+        "Warning: path from videoA (cycle 0) arrives at videoB"
+        " at cycle 2-3 instead of 3",
+        "Warning: path from videoB (cycle 3) reaches no declared cycle",
+    ]
@@ -0,0 +1,107 @@
+import pathlib
+from importlib import reload
+
+import pytest
+
+import asm
+import gcl0x
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[2]
+BINDINGS = ROOT_DIR / "interface.json"
+
+
+def setup_module():
+    reload(asm)
+    reload(gcl0x)
+
+
+def _compile(source, **kwargs):
+    return gcl0x.compileGcl(source, bindings=BINDINGS, **kwargs)
+
+
+@pytest.mark.parametrize("app", ["HelloWorld/HelloWorld", "Snake/Snake_v3"])
+def test_compile_app(app):
+    """compileGcl should give the same GT1 file as compilegcl.py"""
+    source = (ROOT_DIR / "Apps" / (app + ".gcl")).read_text()
+    gt1 = (ROOT_DIR / "Apps" / (app + ".gt1")).read_bytes()
+    assert bytes(_compile(source)) == gt1
+
+
+def test_compile_source():
+    """Code and variables should start where asked"""
+    image = _compile("gcl0x\n\n1 X= X+ Y= [do loop]\n", zpStart=0x40)
+    assert image.execute == 0x200
+    assert image.vars == {"X": 0x40, "Y": 0x42}
+    assert [address for address, _ in image.segments] == [0x200]
+
+    image = _compile("gcl0x [do loop]\n", org=0x300)
+    assert image.execute == 0x300
+
+
+def test_compile_error():
+    """Errors should exit, and leave the current assembler alone"""
+    asm.align(1)
+    asm.ld(1)
+    with pytest.raises(SystemExit):
+        _compile("gcl0x\n\n1 X= ]\n")
+    assert asm.pc() == 1
+    assert bytes(asm.getRom1()) == bytes([1])
+
+
+def test_cycle_report(capsys):
+    """Cycle counts are printed only when asked, with defs by name"""
+    source = "gcl0x\n\n[def 0 X= ret] Zero=\n[def _Spin=* [do loop]] Go=\n"
+    image = _compile(source)
+    assert "Cycles" not in capsys.readouterr().out
+    assert bytes(_compile(source, reportCycles=True)) == bytes(image)
+    report = capsys.readouterr().out.split("Cycles total ")[1]
+    # Zero: LDI STW RET, Spin: BRA in its loop body
+    assert report.split("\n")[1] == " : (main) [88] Zero [52] Spin [14 14]"
+
+
+def _load(image):
+    """Memory contents after loading a GT1 image"""
+    ram = bytearray(0x10000)
+    for address, segment in image.segments:
+        ram[address : address + len(segment)] = segment
+    return ram
+
+
+def test_merged():
+    """Adjacent segments should join, but not across a page boundary"""
+    image = gcl0x.Gt1Image(
+        [
+            (0x0202, b"cd"),
+            (0x0030, b"\x01\x02"),
+            (0x0200, b"ab"),
+            (0x02FF, b"e"),
+            (0x0300, b"f"),
+        ],
+        0x200,
+    )
+    merged = image.merged()
+    assert merged.segments == [
+        (0x0030, b"\x01\x02"),
+        (0x0200, b"abcd"),
+        (0x02FF, b"e"),
+        (0x0300, b"f"),
+    ]
+    assert _load(merged) == _load(image)
+    assert merged.execute == image.execute
+
+
+def test_merged_overlap():
+    """With overlapping segments the load order should stay"""
+    image = gcl0x.Gt1Image(
+        [(0x0201, b"c"), (0x0202, b"d"), (0x0200, b"ab")], 0x200
+    )
+    merged = image.merged()
+    assert merged.segments == [(0x0201, b"cd"), (0x0200, b"ab")]
+    assert _load(merged) == _load(image)
+
+
+def test_loaderFrames():
+    """60 bytes per frame, a frame after every segment, and one to run"""
+    image = gcl0x.Gt1Image([(0x0200, bytes(60)), (0x0300, bytes(61))], 0)
+    assert image.loaderFrames() == (1 + 1) + (2 + 1) + 1
+    assert gcl0x.Gt1Image([], 0).loaderFrames() == 1
@@ -0,0 +1,115 @@
+import pathlib
+import runpy
+import sys
+
+import pytest
+
+import vasm
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT_DIR / "Contrib" / "hsnaves" / "GtForth"))
+
+from vcpu import VirtualCpu  # noqa: E402
+
+BINDINGS = ROOT_DIR / "interface.json"
+
+
+def _assemble(routine, **kwargs):
+    """Main program that calls a floating routine, as GT1 and symbols"""
+    with vasm.Assembler(BINDINGS):
+        vasm.ORG(0x200)
+        vasm.LDI(0)
+        vasm.STW("sysArgs0")
+        vasm.LDWI("routine")
+        vasm.STW("sysArgs2")
+        vasm.CALL("sysArgs2")
+        vasm.L("back")
+        vasm.BRA("back")
+        vasm.ORG(None)
+        vasm.L("routine")
+        routine()
+        gt1 = vasm.END(0x200, filename=None, **kwargs)
+        return gt1, dict(vasm._symbols)
+
+
+def _run(gt1, stop):
+    """Run until vPC reaches stop, return the counter"""
+    cpu = VirtualCpu()
+    cpu.load_gt1(gt1, enable_experimental=True)
+    cpu.run(1000, breakpoints={stop: lambda cpu, _: cpu.halt()})
+    assert cpu.get_vPC() == stop
+    return cpu.read_byte(0x24)  # sysArgs0
+
+
+def _count(n):
+    for _ in range(n):
+        vasm.INC("sysArgs0")
+
+
+def _countReturn(n):
+    _count(n)
+    vasm.RET()
+
+
+def _countForever(n):
+    _count(n)
+    vasm.L("done")
+    vasm.BRA("done")
+
+
+def test_blinky(tmp_path, monkeypatch):
+    """Assembling an app should give its committed GT1 file"""
+    app = ROOT_DIR / "Apps" / "Blinky"
+    monkeypatch.chdir(tmp_path)
+    with vasm.Assembler(BINDINGS):
+        runpy.run_path(str(app / "Blinky2.vasm.py"))
+    gt1 = (app / "Blinky2.gt1").read_bytes()
+    assert (tmp_path / "out.gt1").read_bytes() == gt1
+
+
+def test_listing(tmp_path):
+    """The listing should show the source line of every instruction,
+    once the program asks for them"""
+    lstfile = tmp_path / "out.lst"
+    _assemble(lambda: _countReturn(2), lstfile=lstfile)
+    assert "test_vasm.py" not in lstfile.read_text()
+
+    def routine():
+        vasm.LINES()
+        _countReturn(2)
+
+    _assemble(routine, lstfile=lstfile)
+    lines = lstfile.read_text().splitlines()
+    assert lines[-5:] == [
+        "routine:",
+        '0500  93 24        test_vasm.py:46    vasm.INC("sysArgs0")',
+        '0502  93 24        test_vasm.py:46    vasm.INC("sysArgs0")',
+        "0504  ff           test_vasm.py:51    vasm.RET()",
+        "",
+    ]
+
+
+def test_call_return():
+    """A routine that fits should return to its caller"""
+    gt1, symbols = _assemble(lambda: _countReturn(20))
+    assert _run(gt1, symbols["back"]) == 20
+
+
+def test_split():
+    """A split routine should continue into its rest through CALLI"""
+    gt1, symbols = _assemble(lambda: _countForever(200), romType=0x40)
+    assert symbols["done"] >> 8 != symbols["routine"] >> 8
+    assert _run(gt1, symbols["done"]) == 200
+
+
+@pytest.mark.parametrize("romType", [None, 0x38])
+def test_split_needs_v5a(romType):
+    """Without CALLI in the ROM, a large segment can't be placed"""
+    with pytest.raises(SystemExit):
+        _assemble(lambda: _countForever(200), romType=romType)
+
+
+def test_split_uses_vLR():
+    """A routine that returns can't be split: CALLI overwrites vLR"""
+    with pytest.raises(SystemExit):
+        _assemble(lambda: _countReturn(200), romType=0x40)
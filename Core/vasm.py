@@ -6,12 +6,25 @@
 # As always vCPU mmenomnics are upper case
 # Special words:
 #       ORG(address)    Start new segment
+#       SEGMENT(address) Make a segment without starting it (for callbacks)
 #       L('Name')       Create a label
 #       BYTE(byte,...)  Insert data
 #       END(address)    Finish assembly, address is execution address
+#                       Optionally also write a JSON map with labels and
+#                       source lines (mapfile=...) and a listing (lstfile=...)
+#       LINES()         Record source lines from here on, for the map and
+#                       listing. Without it they have labels and bytes only
+#
+# Segments made with ORG(None) float: END() places them in free RAM with
+# ALLOCATE(), unless another callback is given for that. Segments too
+# large for any free window are only split if END() is told that the
+# program needs ROM v5a or later (romType=...), see ALLOCATE().
 
+import asmbase
 import io
 import json
+import linecache
+import os
 import sys
 
 # The _gt1 variable holds all the segments of the resulting GT1 file.
@@ -30,27 +43,90 @@ import sys
 #              to the start of the segment).
 #              Per-segment label/symbol tables are used because of the
 #              floating segments that might not yet have fixed locations;
-#   - content: the list with the contents of the segment. Each entry
-#              is a byte, a string, or a pair. Strings and pairs are
-#              resolved by _eval() at the end of the assembly process
-#              (when the user invokes END()). Strings are resolved
+#   - content: the contents of the segment, as a _Contents object.
+#              Each entry is emitted as a byte, a string, or a pair.
+#              Bytes go straight into a bytearray. Strings and pairs
+#              are resolved at the end of the assembly process (when
+#              the user invokes END()), and until then they are kept
+#              as fixups next to the bytearray. Strings are resolved
 #              via the _symbols table, and pairs are resolved as follows.
 #              When an entry is a pair (say x), the first entry x[0]
 #              of the pair is  a callback that will be invoked by _eval()
 #              with the argument _eval(x[1]). Note that x[1] itself can
 #              be a byte, a string, or a pair. This will allow for
 #              recursive evaluations of these pairs.
-_gt1 = [(0x200, 0x100, {}, []) ]
-# [ start_addr, size, {label : offset, ...}, [byte, ...],
-               #   start_addr, size, {label : offset, ...}, [byte, ...], ...]
-               # `byte' can be int, symbol string, or expression tuple
+#              Callbacks can still treat the contents as a list: len(),
+#              extend(), iteration and assignment of entries all work.
+
+class _Contents:
+  """Contents of a segment: bytes, and fixups for what END() resolves"""
+
+  def __init__(self, entries=()):
+    self.data = bytearray()
+    self.fixups = []    # [(offset, callback or None, expression), ...]
+    self.starts = []    # Offsets of instructions, where code can be split
+    self.lines = []     # [(offset, code, lasti), ...] of emits after LINES()
+    self.extend(entries)
+
+  def __len__(self):
+    return len(self.data)
+
+  def __iter__(self):
+    # The entries as they were emitted
+    fixups = {offset: (fn, x) if fn else x for offset, fn, x in self.fixups}
+    for offset, byte in enumerate(self.data):
+      yield fixups.get(offset, byte)
 
-_symbols = {}           # name -> value
+  def __setitem__(self, offset, entry):
+    # Replace one entry, for example to patch resolved contents
+    self.fixups = [fixup for fixup in self.fixups if fixup[0] != offset]
+    entry = _Contents([entry])
+    self.fixups += [(offset, fn, x) for _, fn, x in entry.fixups]
+    self.data[offset] = entry.data[0]
+
+  def extend(self, entries):
+    if isinstance(entries, _Contents):
+      base = len(self.data)
+      self.fixups += [(base + offset, fn, x) for offset, fn, x in entries.fixups]
+      self.starts += [base + offset for offset in entries.starts]
+      self.lines += [(base + offset, c, i) for offset, c, i in entries.lines]
+      self.data += entries.data
+      return
+    for x in entries:
+      fn = None
+      if isinstance(x, tuple):
+        fn, x = x[0], x[1]
+        if fn in _pure and isinstance(x, int):
+          fn, x = None, fn(x)           # Fold constant expressions now
+      if isinstance(x, int) and -128 <= x <= 255:
+        self.data.append(x & 255)
+      else:
+        self.fixups.append((len(self.data), fn, x))
+        self.data.append(0)             # Placeholder
+
+  def split(self, offset):
+    # Cut off everything from offset onward, and return that
+    tail = _Contents()
+    tail.data = self.data[offset:]
+    tail.fixups = [(o - offset, fn, x) for o, fn, x in self.fixups if o >= offset]
+    tail.starts = [o - offset for o in self.starts if o >= offset]
+    tail.lines = [(o - offset, c, i) for o, c, i in self.lines if o >= offset]
+    del self.data[offset:]
+    self.fixups = [fixup for fixup in self.fixups if fixup[0] < offset]
+    self.starts = [o for o in self.starts if o < offset]
+    self.lines = [line for line in self.lines if line[0] < offset]
+    return tail
+
+#
+# _gt1, _symbols, _emit_callback, _bindingsFile and _lines hold the state
+# of the current Assembler (see below), and are initialized there.
+_gt1 = None
+# [ start_addr, size, {label : offset, ...}, _Contents,
+               #   start_addr, size, {label : offset, ...}, _Contents, ...]
 
-# Preload system-defined symbols
-with open('interface.json') as file:
-  for (name, value) in json.load(file).items():
-    _symbols[name] = value if isinstance(value, int) else int(value, base=0)
+_symbols = None         # name -> value, or None until _symbolTable()
+_bindingsFile = None    # Interface file with the initial symbols
+_lines = False          # Record source lines, see LINES()
 
 _emit_callback = None
 
@@ -64,9 +140,13 @@ def ORG(addr, size=0x100, callback=None):
   # The callback can be used, for example, to automatically
   # create new segments when current segment is full.
   global _emit_callback
-  _gt1.append((addr, size, {}, []))
+  _gt1.append(SEGMENT(addr, size))
   _emit_callback = callback
 
+def SEGMENT(addr, size=0x100):
+  # A new and empty segment, for callbacks that add segments to _gt1
+  return (addr, size, {}, _Contents())
+
 def LDWI(op):  return _emit((0x11, (LO,op), (HI,op)))
 def LD(op):    return _emit((0x1a, op))
 def LDW(op):   return _emit((0x21, op))
@@ -109,10 +189,11 @@ def RET():     return _emit((0xff,))
 def CALLI(op): return _emit((0x85, (LO,op), (HI,op)))
 def CMPHS(op): return _emit((0x1f, op))
 def CMPHU(op): return _emit((0x97, op))
-def BYTE(*op): return _emit(op)
+def BYTE(*op): return _emit(op, code=False)
 
 def L(name):
-  if name in _symbols:
+  symbols = _symbolTable()
+  if name in symbols:
     ERR('Redefined %s' % repr(name))
 
   _emit([]) # To call the emit callback before we define labels
@@ -124,31 +205,146 @@ def L(name):
   segment[2][name] = len(segment[3])
   if segment[0] is not None:
     # If the symbol can be resolved now, resolve it already
-    _symbols[name] = segment[0] + len(segment[3])
+    symbols[name] = segment[0] + len(segment[3])
   else:
-    _symbols[name] = None
+    symbols[name] = None
+
+def LINES():
+  # Finding the source line of each emit is relatively slow, so _emit()
+  # only does this when the program asks for it
+  global _lines
+  _lines = True
 
 def ALIGN(nbytes=2):
   segment = _gt1[-1]
   addr = segment[0] + len(segment[3])
   rem = addr % nbytes
   if rem != 0:
-    _emit(tuple([0] * (nbytes - rem)))
+    _emit(tuple([0] * (nbytes - rem)), code=False)
 
 def RESOLVE_SEGMENTS(callback):
   # The RESOLVE_SEGMENTS() function is mainly used to resolve
   # the `floating` segments, i.e. segments without a defined start address.
   # The callback is then responsible for modifying _gt1 to place and
   # resolve these segments.
-  return callback(_gt1, _symbols)
+  return callback(_gt1, _symbolTable())
+
+# Free RAM for floating segments in a 32K system, as (start, end). Pages
+# 2 to 4 end at 250 bytes, because the sound channels are at the top. In
+# the video area only the 96 bytes right of the pixels are free. Page 1
+# holds the video table.
+_freeRam = [(page, page + 250) for page in range(0x200, 0x500, 0x100)] +\
+           [(page, page + 256) for page in range(0x500, 0x800, 0x100)] +\
+           [(page + 160, page + 256) for page in range(0x800, 0x8000, 0x100)]
+
+def ALLOCATE(gt1, symbols, romType=None):
+  # Callback for RESOLVE_SEGMENTS() that places floating segments in the
+  # free RAM around the fixed segments. To make few GT1 segments, they're
+  # packed together: largest first, each where it leaves the least room,
+  # or else at the start of the largest free window. A segment that fits
+  # nowhere is split at an instruction that no branch crosses, and CALLI
+  # continues into the rest. CALLI needs ROM v5a, so this is only done
+  # when romType says so. And CALLI overwrites vLR: a segment that uses
+  # vLR (RET, PUSH, or vLR as operand) is never split, because a RET
+  # after the split would return into the CALLI instead of to its caller.
+  canSplit = romType is not None and romType >= symbols.get('romTypeValue_ROMv5', 0x40)
+  fixed = [segment for segment in gt1 if segment[0] is not None]
+  used = sorted((s[0], s[0] + len(s[3])) for s in fixed if len(s[3]) > 0)
+  windows = []
+  for start, end in _freeRam:
+    for a, b in used:
+      if a < end and b > start:
+        if a > start:
+          windows.append((start, a))
+        start = max(start, b)
+    if start < end:
+      windows.append((start, end))
+  windows.sort(key=lambda w: w[0] - w[1]) # Largest first
+
+  queue = [s for s in gt1 if s[0] is None and len(s[3]) > 0]
+  queue.sort(key=lambda s: -len(s[3]))
+  bins = [] # [(start, end, labels, contents), ...]
+  while queue:
+    _, _, labels, contents = queue.pop(0)
+    room = lambda b: b[1] - b[0] - len(b[3])
+    fits = [b for b in bins if room(b) >= len(contents)]
+    if fits:
+      b = min(fits, key=room)
+    elif windows:
+      start, end = windows.pop(0)
+      b = (start, end, {}, _Contents())
+      bins.append(b)
+      if len(contents) > end - start:
+        if not canSplit:
+          ERR('Floating segment too large (%d bytes),' % len(contents),
+              'splitting needs romType for ROM v5a or later')
+        if _usesLR(contents, symbols):
+          ERR('Floating segment too large (%d bytes),' % len(contents),
+              'and it uses vLR so it can\'t be split')
+        offset = _splitPoint(labels, contents, end - start - 3)
+        if offset is None:
+          ERR('Floating segment too large (%d bytes)' % len(contents))
+        name = '__split%d__' % len(symbols)
+        tail = (None, None, {name: 0}, contents.split(offset))
+        for label, o in list(labels.items()):
+          if o >= offset:
+            tail[2][label] = o - offset
+            del labels[label]
+        symbols[name] = None
+        contents.extend((0x85, (LO,name), (HI,name))) # CALLI to the rest
+        contents.starts.append(offset)
+        queue.append(tail)
+        queue.sort(key=lambda s: -len(s[3]))
+    else:
+      ERR('No free RAM for floating segment (%d bytes)' % len(contents))
+    for label, offset in labels.items():
+      b[2][label] = len(b[3]) + offset
+    b[3].extend(contents)
+
+  gt1[:] = fixed + [(start, end - start, labels, contents)
+                    for start, end, labels, contents in sorted(bins)]
+  for address, _, labels, _ in gt1:
+    for label, offset in labels.items():
+      symbols[label] = address + offset
+
+def _splitPoint(labels, contents, room):
+  # Last instruction within room that no branch in the segment crosses
+  branches = [(o, labels[x]) for o, fn, x in contents.fixups
+              if fn is _br and isinstance(x, str) and x in labels]
+  for offset in reversed(contents.starts):
+    if 0 < offset <= room and all((o < offset) == (t < offset) for o, t in branches):
+      return offset
+  return None
+
+# Instructions with vLR as zero page operand would be one of these
+_zpOps = {0x1a, 0x21, 0x2b, 0x5e, 0x93, 0x99, 0xb8, 0xcf, 0xf0, 0xf3, 0xf8, 0xfa, 0xfc}
 
-def END(start=0x200, filename='out.gt1', resolve_callback=None):
+def _usesLR(contents, symbols):
+  # Any RET or PUSH instruction, or an instruction that accesses vLR
+  fixups = {offset: x for offset, _, x in contents.fixups}
+  for offset in contents.starts:
+    opcode = contents.data[offset]
+    if opcode in (0xff, 0x75):
+      return True
+    if opcode in _zpOps and offset + 1 < len(contents):
+      operand = fixups.get(offset + 1, contents.data[offset + 1])
+      if operand in ('vLR', symbols.get('vLR')):
+        return True
+  return False
+
+def END(start=0x200, filename='out.gt1', resolve_callback=None,
+        mapfile=None, lstfile=None, romType=None):
+  if resolve_callback is None:
+    if any(segment[0] is None and len(segment[3]) > 0 for segment in _gt1):
+      romType = _eval(romType) if romType is not None else None
+      resolve_callback = lambda gt1, symbols: ALLOCATE(gt1, symbols, romType)
   if resolve_callback is not None:
     RESOLVE_SEGMENTS(resolve_callback)
   if filename is not None:
     _f = open(filename, 'wb')
   else:
     _f = io.BytesIO()
+  placed = [] # [(address, labels, contents, resolved), ...]
   with _f as f:
     for segment in _gt1:
       address, size, labels, contents = segment
@@ -157,19 +353,84 @@ def END(start=0x200, filename='out.gt1', resolve_callback=None):
           ERR('Segment too large at 0x%04X' % address)
         if address + len(contents) > (address | 255) + 1:
           ERR('Page overrun in segment 0x%04X' % address)
-        resolved = [_byte(_eval(x)) for x in contents]
+        if not isinstance(contents, _Contents):
+          contents = _Contents(contents) # Made by a callback
+        resolved = contents.data[:]
+        for offset, fn, x in contents.fixups:
+          x = _eval(x)
+          if fn is _br and x >> 8 != (address + offset) >> 8:
+            ERR('Branch to other page at 0x%04X' % (address + offset))
+          resolved[offset] = _byte(fn(x) if fn else x)
         f.write(bytes([address >> 8, address & 255, len(resolved) & 255]))
-        f.write(bytes(resolved))
+        f.write(resolved)
+        placed.append((address, labels, contents, resolved))
     start = _eval(start)
     f.write(bytes([0, start >> 8, start & 255]))
+    if mapfile is not None:
+      _writeMap(mapfile, placed, start)
+    if lstfile is not None:
+      _writeListing(lstfile, placed)
     if filename is None:
         return f.getvalue()
 
-def _emit(ins):
+def _writeMap(mapfile, placed, start):
+  # Labels and the source line of every emitted piece, by address, for
+  # tools that want to show where they are in the program
+  labels, lines, cache = {}, [], {}
+  for address, segmentLabels, contents, resolved in placed:
+    for label, offset in segmentLabels.items():
+      labels[label] = address + offset
+    for i, (offset, code, lasti) in enumerate(contents.lines):
+      end = contents.lines[i+1][0] if i+1 < len(contents.lines) else len(resolved)
+      if end > offset:
+        lineno = asmbase.sourceLine(code, lasti, cache)
+        lines.append([address + offset, end - offset, code.co_filename, lineno])
+  with open(mapfile, 'w') as f:
+    json.dump({'start': start, 'labels': labels, 'lines': lines}, f)
+
+def _writeListing(lstfile, placed):
+  # Address, bytes and source line of everything emitted, with labels
+  cache = {}
+  with open(lstfile, 'w') as f:
+    for address, labels, contents, resolved in placed:
+      names = {}
+      for label, offset in labels.items():
+        names.setdefault(offset, []).append(label)
+      # Bytes without a source (added by callbacks) join the ones before
+      pieces = contents.lines
+      if not pieces or pieces[0][0] > 0:
+        pieces = [(0, None, None)] + pieces
+      print('; Segment $%04x size %d' % (address, len(resolved)), file=f)
+      for i, (offset, code, lasti) in enumerate(pieces):
+        end = pieces[i+1][0] if i+1 < len(pieces) else len(resolved)
+        for label in names.get(offset, []):
+          print('%s:' % label, file=f)
+        source = ''
+        if code:
+          filename, lineno = code.co_filename, asmbase.sourceLine(code, lasti, cache)
+          source = '%s:%-5d %s' % (os.path.basename(filename), lineno,
+                                   linecache.getline(filename, lineno).strip())
+        for o in range(offset, end, 4): # At most 4 bytes per line
+          data = ' '.join('%02x' % b for b in resolved[o:min(o+4, end)])
+          print('%04x  %-11s  %s' % (address + o, data, source), file=f)
+          source = ''
+      for label in names.get(len(resolved), []):
+        print('%s:' % label, file=f)
+      print(file=f)
+
+def _emit(ins, code=True):
   if _emit_callback is not None:
     _emit_callback(_gt1, ins)
-  segment = _gt1[-1]
-  segment[3].extend(ins)
+  contents = _gt1[-1][3]
+  if len(ins) > 0 and isinstance(contents, _Contents):
+    if code:
+      contents.starts.append(len(contents))
+    if _lines:
+      frame = sys._getframe(1)
+      while frame.f_back and frame.f_code.co_filename == __file__:
+        frame = frame.f_back # To the program, out of vasm
+      contents.lines.append((len(contents), frame.f_code, frame.f_lasti))
+  contents.extend(ins)
   return 0
 
 def LO(x): return _eval(x) & 255        # Low byte of word
@@ -177,12 +438,16 @@ def HI(x): return _eval(x) >> 8         # High byte of word
 def ADDR(x): return _eval(x)            # The address of the label
 def _br(x): return (_eval(x) - 2) & 255 # Adjust for pre-increment of vPC
 
+# Callbacks that can be applied as soon as their argument is a number
+_pure = {LO, HI, ADDR, _br}
+
 def _eval(x):
   fn = lambda x: x                      # No operation
   if isinstance(x, tuple):              # Tuple expressions
     fn, x = x[0], _eval(x[1])
   if isinstance(x, str):                # Resolve symbol strings
-    x = _symbols[x] if x in _symbols else ERR('Undefined %s' % repr(x))
+    symbols = _symbolTable()
+    x = symbols[x] if x in symbols else ERR('Undefined %s' % repr(x))
   return fn(x)
 
 def _byte(x):
@@ -194,3 +459,58 @@ def ERR(*args):
   line = 'Error: ' + ' '.join(args)
   print('\033[1m' + line + '\033[0m' if sys.stdout.isatty() else line)
   sys.exit(1)
+
+#------------------------------------------------------------------------
+#       Assemblers
+#------------------------------------------------------------------------
+
+_stateNames = ['_gt1', '_symbols', '_emit_callback', '_bindingsFile', '_lines']
+
+class Assembler(asmbase.State):
+  """Complete vasm state for assembling one program
+
+  All special words act on the current assembler. An Assembler becomes
+  current while used as context manager, so several programs can be
+  assembled in one process, one after the other:
+
+    with Assembler('interface.json'):
+      runpy.run_path('Apps/Blinky/Blinky2.vasm.py')
+
+  The symbols start as those of the interface file (if any), which is
+  read when they are first needed. For the initial assembler this is
+  interface.json in the current directory.
+  """
+  _globals, _names = globals(), _stateNames
+
+  def __init__(self, bindings='interface.json'):
+    super().__init__({
+      '_gt1': [SEGMENT(0x200)],
+      '_symbols': None,
+      '_emit_callback': None,
+      '_bindingsFile': bindings,
+      '_lines': False,
+    })
+
+# Parsed interface files, shared by all assemblers in the process
+# File name -> (modification time, symbols)
+_bindings = {}
+
+def _loadBindings(symfile):
+  symfile = str(symfile)
+  mtime = os.stat(symfile).st_mtime_ns
+  if symfile not in _bindings or _bindings[symfile][0] != mtime:
+    with open(symfile) as file:
+      symbols = {name: value if isinstance(value, int) else int(value, base=0)
+                 for name, value in json.load(file).items()}
+    _bindings[symfile] = mtime, symbols
+  return _bindings[symfile][1]
+
+def _symbolTable():
+  # The symbols of the current assembler, starting from its interface file
+  global _symbols
+  if _symbols is None:
+    _symbols = dict(_loadBindings(_bindingsFile)) if _bindingsFile else {}
+  return _symbols
+
+_current = None
+Assembler().activate()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+#-----------------------------------------------------------------------
+#
+#  asmbench.py -- Micro-benchmark for the native code assembler
+#
+#  Repeatedly assembles a mix of native instructions typical for the
+#  ROM sources, and reports how many instructions are assembled per
+#  second. Nothing is written to disk.
+#
+#-----------------------------------------------------------------------
+
+import argparse
+import sys
+from os.path import dirname, join
+from timeit import default_timer as timer
+
+sys.path.insert(0, join(dirname(__file__), '..', 'Core'))
+import asm
+from asm import *
+
+parser = argparse.ArgumentParser(description='Benchmark native instruction assembly')
+parser.add_argument('-n', dest='rounds', type=int, default=5,
+                    help='Number of rounds, best one is reported (default 5)')
+args = parser.parse_args()
+
+def page():
+  """One 256-word page of assorted instructions"""
+  for i in range(16):
+    ld([0x30])
+    ld([Y,X])
+    ld(AC, X)
+    adda(1)
+    anda([Y,0x40])
+    xora(0xff)
+    st([0x30])
+    st([Y,Xpp])
+    st(0x2a, [Y,Xpp])
+    ctrl(Y, Xpp)
+    ld(hi('bench'), Y)
+    jmp(Y, 'bench')
+    bne('bench')
+    bra(AC)
+    suba([X])
+    nop()
+
+best = None
+for _ in range(args.rounds):
+  with asm.Assembler():
+    align(1)
+    label('bench')
+    start = timer()
+    for _ in range(255):
+      page()
+    elapsed = timer() - start
+  best = elapsed if best is None else min(best, elapsed)
+
+count = 255 * 256
+print('Assembled %d instructions in %.3fs (%.0f per second)' % (count, best, count / best))
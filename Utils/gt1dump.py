@@ -45,6 +45,7 @@
 #-----------------------------------------------------------------------
 
 import argparse
+import json
 import pathlib
 import re
 import sys
@@ -70,6 +71,9 @@ parser.add_argument('-dv', '--disassemble-vcpu', dest='disassemble',
 parser.add_argument('-p', '--prof', dest='prof',
                     help='display profile information from file ARG',
                     action='store', metavar='PFILE')
+parser.add_argument('-m', '--map', dest='map',
+                    help='show labels from vasm map file ARG',
+                    action='store', metavar='MFILE')
 parser.add_argument('filename', help='GT1 file', nargs='?')
 
 args = parser.parse_args()
@@ -323,7 +327,13 @@ if args.prof:
     exec(f.read(), gb)
     prof = gb['prof']
     profa = sorted(prof.keys())
-  
+
+labels = {}
+if args.map:
+  with open(args.map) as f:
+    for label, value in json.load(f)['labels'].items():
+      labels.setdefault(value, []).append(label)
+
 hiAddress = readByte(fp)
 
 cpuType, cpuTag = 0, '[vCPU]'                   # 0 for vCPU, 1 for v6502
@@ -343,6 +353,13 @@ while True:
   insaddr = None
   for i in range(segmentSize):
 
+    if address+i in labels and ops == 0:        # Labels from map file
+      if j > 0:                                 # Force new line
+        print('%s|%s|' % ((51-j)*' ', text))
+        j, text = 0, ''
+      for label in labels[address+i]:
+        print('%s:' % label)
+
     byte = readByte(fp)                         # Data byte
 
     if args.disassemble and hiAddress > 0:      # Attempt disassembly